@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#*
+#* Copyright (C) 2006 - 2012,  Jérôme Kieffer <imagizer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#*****************************************************************************/
+"""
+Benchmark of the engines of blur.Gaussian (separable convolution, recursive
+filter and FFT) for several image shapes and sigma values.
+The last column gives the engine retained by Gaussian.calibrate for this
+shape, and the engine the automatic choice would use without calibration.
+
+usage: bench_blur.py [sigma1 sigma2 ...]
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import sys
+from imagizer import blur
+
+SHAPES = [(256, 256), (512, 768), (1024, 1536), (2048, 3072)]
+SIGMAS = [1.5, 4, 11.77]
+REPEAT = 3
+
+
+def main(sigmas):
+    gaussian = blur.Gaussian()
+    print("%-12s %6s %10s %10s %10s  %-10s %-10s" % ("shape", "sigma", "separable", "recursive", "fft", "best", "heuristic"))
+    for sigma in sigmas:
+        for shape in SHAPES:
+            k0, k1 = gaussian._sigmas(sigma)
+            heuristic = gaussian.chooseEngine((shape[0] + 2 * k0, shape[1] + 2 * k1), k0, k1)
+            timings = gaussian.calibrate(shape, sigma, REPEAT)
+            best = min(timings, key=timings.get)
+            print("%-12s %6.2f %9.1fms %9.1fms %9.1fms  %-10s %-10s" % ("%ix%i" % shape, sigma,
+                  1000 * timings["separable"], 1000 * timings["recursive"], 1000 * timings["fft"], best, heuristic))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main([float(i) for i in sys.argv[1:]])
+    else:
+        main(SIGMAS)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#*
+#* Copyright (C) 2006 - 2012,  Jérôme Kieffer <imagizer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#*****************************************************************************/
+"""
+Benchmark of the JPEG decoding used for display and thumbnails:
+full decoding followed by a downscale (as before) versus reduced 
+DCT-domain decoding with PIL's draft mode (as in Photo.getReducedPIL).
+
+usage: bench_decode.py image1.jpg [image2.jpg ...]
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import sys, time
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+
+TARGETS = [("screen", 1024), ("scaled", 800), ("thumb", 160)]
+REPEAT = 3
+
+
+def full_decode(filename, size):
+    """Former path: decode at full resolution then downscale"""
+    img = Image.open(filename)
+    img.load()
+    img = img.copy()
+    img.thumbnail((size, size), Image.ANTIALIAS)
+    return img
+
+
+def reduced_decode(filename, size):
+    """New path: let libjpeg decode at 1/2, 1/4 or 1/8 then downscale"""
+    img = Image.open(filename)
+    ratio = min(1.0, float(size) / max(img.size))
+    img.draft("RGB", (int(ratio * img.size[0]), int(ratio * img.size[1])))
+    img.thumbnail((size, size), Image.ANTIALIAS)
+    return img
+
+
+def timeit(func, filename, size):
+    """best time out of REPEAT runs"""
+    best = None
+    for _ in range(REPEAT):
+        t0 = time.time()
+        func(filename, size)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main(filenames):
+    print("%-40s %-7s %12s %12s %8s" % ("image", "target", "full ms/Mpix", "draft ms/Mpix", "speed-up"))
+    for filename in filenames:
+        width, height = Image.open(filename).size
+        mpix = width * height / 1e6
+        for name, size in TARGETS:
+            full = timeit(full_decode, filename, size)
+            reduced = timeit(reduced_decode, filename, size)
+            print("%-40s %-7s %12.2f %12.2f %8.1fx" % (filename[-40:], name, 1000 * full / mpix, 1000 * reduced / mpix, full / reduced))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#*
+#* Copyright (C) 2006 - 2012,  Jérôme Kieffer <imagizer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#*****************************************************************************/
+"""
+Benchmark of the thumbnail engines: PIL (reduced decoding with draft,
+downscale and JPEG encoding, as in Photo.saveRenditions) versus the
+C code of libexiftran (libexiftran.thumbnail).
+The last column gives the throughput of libexiftran with one thread
+per processor, as the GIL is released during the processing.
+
+usage: bench_thumbnail.py image1.jpg [image2.jpg ...]
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import sys, os, time, tempfile, threading, multiprocessing
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+import libexiftran
+
+SIZE = 160
+QUALITY = 75
+REPEAT = 3
+
+
+def pil_thumbnail(filename, output):
+    """PIL path of Photo.saveRenditions"""
+    img = Image.open(filename)
+    ratio = min(1.0, float(SIZE) / max(img.size))
+    img.draft("RGB", (int(ratio * img.size[0]), int(ratio * img.size[1])))
+    img.load()
+    img.thumbnail((SIZE, SIZE), Image.ANTIALIAS)
+    img.save(output, quality=QUALITY)
+
+
+def c_thumbnail(filename, output):
+    """libexiftran path"""
+    libexiftran.thumbnail(filename, SIZE, QUALITY, 0, 0, output)
+
+
+def timeit(func, filename, output):
+    """best time out of REPEAT runs"""
+    best = None
+    for _ in range(REPEAT):
+        t0 = time.time()
+        func(filename, output)
+        dt = time.time() - t0
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def threaded(filenames, output):
+    """thumbnails/s with libexiftran in one thread per processor"""
+    lstFiles = list(filenames) * REPEAT
+    lock = threading.Lock()
+    def worker(idx):
+        while True:
+            with lock:
+                if not lstFiles:
+                    return
+                filename = lstFiles.pop()
+            c_thumbnail(filename, "%s.%i.jpg" % (output, idx))
+    nbThreads = multiprocessing.cpu_count()
+    nbImages = len(lstFiles)
+    t0 = time.time()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(nbThreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    dt = time.time() - t0
+    for i in range(nbThreads):
+        if os.path.exists("%s.%i.jpg" % (output, i)):
+            os.unlink("%s.%i.jpg" % (output, i))
+    return nbImages / dt, nbThreads
+
+
+def main(filenames):
+    fd, output = tempfile.mkstemp(suffix=".jpg")
+    os.close(fd)
+    try:
+        print("%-40s %10s %10s %8s" % ("image", "PIL ms", "C ms", "speed-up"))
+        for filename in filenames:
+            pil = timeit(pil_thumbnail, filename, output)
+            c = timeit(c_thumbnail, filename, output)
+            print("%-40s %10.1f %10.1f %8.1fx" % (filename[-40:], 1000 * pil, 1000 * c, pil / c))
+        rate, nbThreads = threaded(filenames, output)
+        print("libexiftran with %i threads: %.1f thumbnails/s" % (nbThreads, rate))
+    finally:
+        os.unlink(output)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1:])
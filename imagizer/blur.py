@@ -24,15 +24,19 @@
 #*
 #*****************************************************************************/
 """
-Module contains a class for gaussian blur
+Module contains a class for gaussian blur, with three engines:
+ - "separable": two 1-D convolutions with a kernel truncated at 4 sigma, for small sigma
+ - "recursive": IIR approximation of Young & van Vliet, whose cost does not depend on sigma
+ - "fft": product with the kernel in Fourier space (real transforms), exact on the padded image
 """
 
 __author__ = "Jérôme Kieffer"
 __contact__ = "imagizer@terre-adelie.org"
-__date__ = "20111023"
+__date__ = "20121018"
 __license__ = "GPL"
 
-import numpy, logging, sys, threading
+import numpy, logging, sys, threading, time
+from collections import OrderedDict
 logger = logging.getLogger("imagizer.blur")
 from numpy import ceil, floor
 
@@ -65,6 +69,25 @@ def gaussian(M, std):
 
 
 
+def young_vliet(sigma):
+    """
+    Coefficients of the recursive gaussian filter of Young and van Vliet (1995)
+    
+    @param sigma: standard deviation (>=0.5)
+    @return: B, b1, b2, b3 normalized by b0
+    """
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * numpy.sqrt(1.0 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q ** 2 + 0.422205 * q ** 3
+    b1 = (2.44413 * q + 2.85619 * q ** 2 + 1.26661 * q ** 3) / b0
+    b2 = -(1.4281 * q ** 2 + 1.26661 * q ** 3) / b0
+    b3 = 0.422205 * q ** 3 / b0
+    return 1.0 - (b1 + b2 + b3), b1, b2, b3
+
+
+
 def expand(data, sigma, mode="constant", cval=0.0):
     """Expand array a with its reflection on boundaries
     
@@ -113,14 +136,104 @@ def expand(data, sigma, mode="constant", cval=0.0):
 class Gaussian(object):
     """
     A class that tries to do gaussian blur as fast as possible
+    
+    The engine is chosen for each shape and sigma, either from the timings 
+    measured by calibrate or from the cost of each engine. 
+    Kernels and FFT plans are kept in a LRU cache.
     """
-    def __init__(self):
-        self.dictGaussian = {}
+    ENGINES = ["separable", "recursive", "fft"]
+
+    def __init__(self, engine="auto", maxKernels=16):
+        """
+        @param engine: "auto" or one of Gaussian.ENGINES
+        @param maxKernels: number of kernels and FFT plans kept in cache
+        """
+        self.engine = engine
+        self.maxKernels = maxKernels
+        self.dictGaussian = OrderedDict()
+        self.dictEngine = {}
         self.lock = threading.Semaphore()
 
-    def blur(self, data, sigma, mode="reflect", cval=0.0):
+    def getKernel(self, key, builder):
+        """
+        Retrieve a kernel (or a plan) from the LRU cache, building it if needed
+        
+        @param key: hashable key of the kernel
+        @param builder: function without argument building the kernel
+        """
+        with self.lock:
+            if key in self.dictGaussian:
+                value = self.dictGaussian.pop(key)
+                self.dictGaussian[key] = value
+                return value
+        value = builder()
+        with self.lock:
+            self.dictGaussian[key] = value
+            while len(self.dictGaussian) > self.maxKernels:
+                self.dictGaussian.popitem(last=False)
+        return value
+
+    def chooseEngine(self, shape, k0, k1):
+        """
+        Select the engine for a padded image of a given shape
+        
+        @param shape: shape of the image
+        @param k0, k1: standard deviation along each axis
+        @return: name of the engine
+        """
+        if self.engine != "auto":
+            return self.engine
+        key = (shape, k0, k1)
+        if key in self.dictEngine:
+            return self.dictEngine[key]
+        if 8 * max(k0, k1) + 1 <= 17:
+            return "separable"
+        elif shape[0] * shape[1] > 4 * 2 ** 20:
+            return "recursive"
+        else:
+            return "fft"
+
+    def calibrate(self, shape, sigma, repeat=1):
+        """
+        Measure the time taken by each engine for images of a given shape
+        and keep the fastest one for this shape in "auto" mode.
+        
+        @param shape: 2-tuple, shape of the images to blur
+        @param sigma: standard deviation of the blur
+        @param repeat: number of measurements per engine
+        @return: dict with the best time for each engine
+        """
+        data = numpy.random.random(shape).astype("float32") * 255
+        timings = {}
+        for engine in self.ENGINES:
+            best = None
+            for i in range(repeat):
+                t0 = time.time()
+                self.blur(data, sigma, engine=engine)
+                dt = time.time() - t0
+                if best is None or dt < best:
+                    best = dt
+            timings[engine] = best
+        k0, k1 = self._sigmas(sigma)
+        padded = (shape[0] + 2 * k0, shape[1] + 2 * k1)
+        self.dictEngine[(padded, k0, k1)] = min(timings, key=timings.get)
+        logger.debug("Gaussian.calibrate %s %s: %s", shape, sigma, timings)
+        return timings
+
+    @staticmethod
+    def _sigmas(sigma):
+        """
+        @return: standard deviations along each axis, rounded up like gaussian() expects
+        """
+        if isinstance(sigma, (list, tuple)):
+            return int(ceil(float(sigma[0]))), int(ceil(float(sigma[1])))
+        else:
+            k = int(ceil(float(sigma)))
+            return k, k
+
+    def blur(self, data, sigma, mode="reflect", cval=0.0, engine=None):
         """
-        2-dimensional Gaussian filter implemented with FFTw
+        2-dimensional Gaussian filter
 
         @param data:    data array to filter
         @type data: array-like
@@ -134,54 +247,109 @@ class Gaussian(object):
             'constant'. Default is 'reflect'
         @param cval: scalar, optional
             Value to fill past edges of data if ``mode`` is 'constant'. Default is 0.0
+        @param engine: force one of Gaussian.ENGINES, by default it is chosen automatically 
         """
         if mode != "wrap":
             data = expand(data, sigma, mode, cval)
         s0, s1 = data.shape
-        if isinstance(sigma, (list, tuple)):
-            k0 = int(ceil(float(sigma[0])))
-            k1 = int(ceil(float(sigma[1])))
+        k0, k1 = self._sigmas(sigma)
+        if engine is None:
+            engine = self.chooseEngine((s0, s1), k0, k1)
+        if engine == "separable":
+            res = self._separable(self._separable(data, k0, 0), k1, 1)
+        elif engine == "recursive":
+            res = self._recursive(self._recursive(data, k0, 0), k1, 1)
         else:
-            k0 = k1 = int(ceil(float(sigma)))
-        if fftw3 is None:
-            #Numpy implenentation
-            if (s0, s1, k0, k1) not in self.dictGaussian:
-                g0 = gaussian(s0, k0)
-                g1 = gaussian(s1, k1)
-                g0 = numpy.concatenate((g0[s0 // 2:], g0[:s0 // 2]))
-                g1 = numpy.concatenate((g1[s1 // 2:], g1[:s1 // 2]))
-                g2 = numpy.outer(g0, g1)
-                self.dictGaussian[(s0, s1, k0, k1) ] = numpy.fft.fft2(g2 / g2.sum()).conjugate()
-            blured = numpy.fft.ifft2(numpy.fft.fft2(data) * self.dictGaussian[(s0, s1, k0, k1) ]).real
+            res = self._fft(data, k0, k1)
+        if mode == "wrap":
+            blured = res
         else:
-            sum_init = data.astype("float32").sum()
-            fftOut = numpy.zeros((s0, s1), dtype=complex)
-            fftIn = numpy.zeros((s0, s1), dtype=complex)
+            blured = res[k0:-k0, k1:-k1]
+        return  blured
+
+    def _separable(self, data, std, axis):
+        """
+        1-D convolution with a gaussian truncated at 4 sigma, 
+        the image being extended with its border values.
+        
+        @param data: 2D array
+        @param std: standard deviation
+        @param axis: axis of the convolution
+        """
+        def builder():
+            r = int(ceil(4.0 * std))
+            g = numpy.exp(-(numpy.arange(-r, r + 1, dtype="float32") / std) ** 2 / 2.0)
+            return g / g.sum()
+        kernel = self.getKernel(("separable", std), builder)
+        r = len(kernel) // 2
+        n = data.shape[axis]
+        padded = data.take(numpy.arange(-r, n + r).clip(0, n - 1), axis=axis)
+        out = numpy.zeros(data.shape, dtype="float32")
+        for i, w in enumerate(kernel):
+            if axis == 0:
+                out += w * padded[i:i + n]
+            else:
+                out += w * padded[:, i:i + n]
+        return out
+
+    def _recursive(self, data, std, axis):
+        """
+        Recursive (IIR) gaussian filter of Young and van Vliet along one axis:
+        a causal then an anti-causal pass, vectorised over the other axis.
+        
+        @param data: 2D array
+        @param std: standard deviation
+        @param axis: axis of the filter
+        """
+        B, b1, b2, b3 = self.getKernel(("recursive", std), lambda: young_vliet(std))
+        if axis == 1:
+            data = numpy.ascontiguousarray(data.T)
+        out = numpy.empty(data.shape, dtype="float32")
+        n = data.shape[0]
+        p1 = p2 = p3 = data[0].astype("float32")
+        for i in xrange(n):
+            cur = B * data[i] + b1 * p1 + b2 * p2 + b3 * p3
+            out[i] = cur
+            p1, p2, p3 = cur, p1, p2
+        p1 = p2 = p3 = out[n - 1].copy()
+        for i in xrange(n - 1, -1, -1):
+            cur = B * out[i] + b1 * p1 + b2 * p2 + b3 * p3
+            out[i] = cur
+            p1, p2, p3 = cur, p1, p2
+        if axis == 1:
+            out = numpy.ascontiguousarray(out.T)
+        return out
+
+    def _fft(self, data, k0, k1):
+        """
+        Circular convolution with the gaussian in Fourier space, 
+        with real transforms and plans reused from one call to the other.
+        
+        @param data: 2D array
+        @param k0, k1: standard deviation along each axis
+        """
+        s0, s1 = data.shape
+        def builder():
+            g0 = gaussian(s0, k0)
+            g1 = gaussian(s1, k1)
+            g0 = numpy.concatenate((g0[s0 // 2:], g0[:s0 // 2]))
+            g1 = numpy.concatenate((g1[s1 // 2:], g1[:s1 // 2]))
+            g2 = numpy.outer(g0, g1)
+            return numpy.fft.rfft2(g2 / g2.sum()).conjugate()
+        kernel = self.getKernel(("fft", s0, s1, k0, k1), builder)
+        if fftw3 is None:
+            return numpy.fft.irfft2(numpy.fft.rfft2(data) * kernel, (s0, s1)).astype("float32")
+
+        def planner():
+            fftIn = numpy.zeros((s0, s1), dtype="float64")
+            fftOut = numpy.zeros((s0, s1 // 2 + 1), dtype=complex)
             fft = fftw3.Plan(fftIn, fftOut, direction='forward')
             ifft = fftw3.Plan(fftOut, fftIn, direction='backward')
-
-            if (s0, s1, k0, k1) not in self.dictGaussian:
-                g0 = gaussian(s0, k0)
-                g1 = gaussian(s1, k1)
-                g0 = numpy.concatenate((g0[s0 // 2:], g0[:s0 // 2]))
-                g1 = numpy.concatenate((g1[s1 // 2:], g1[:s1 // 2]))
-                g2 = numpy.outer(g0, g1)
-                g2fft = numpy.zeros((s0, s1), dtype=complex)
-                fftIn[:, :] = g2.astype(complex) / g2.sum()
-                fft()
-                g2fft[:, :] = fftOut.conjugate()
-                self.dictGaussian[(s0, s1, k0, k1) ] = g2fft
-
-            fftIn[:, :] = data.astype(complex)
+            return fftIn, fftOut, fft, ifft, threading.Lock()
+        fftIn, fftOut, fft, ifft, lock = self.getKernel(("plan", s0, s1), planner)
+        with lock:
+            fftIn[:, :] = data
             fft()
-            fftOut *= self.dictGaussian[(s0, s1, k0, k1) ]
+            fftOut *= kernel
             ifft()
-            out = fftIn.real.astype("float32")
-            sum_out = out.sum()
-            res = out * sum_init / sum_out
-            if mode == "wrap":
-                blured = res
-            else:
-                blured = res[k0:-k0, k1:-k1]
-        return  blured
-
+            return (fftIn / (s0 * s1)).astype("float32")
@@ -93,6 +93,11 @@ class Config:
             self.SynchronizeRep = "user@host:/mnt/photo"
             self.SynchronizeType = "Newer"
             self.ImageCache = 100
+            self.ImageCacheMemory = 512
+            self.PrefetchDepth = 2
+            self.NbrWorkers = 0
+            self.MetadataIndexFile = ".imagizer-index.sqlite"
+            self.IncrementalScan = True
             self.ImageWidth = None
             self.ImageHeight = None
             self.DEBUG = None
@@ -107,7 +112,8 @@ class Config:
                 "Progressive":False,
                 "Optimize":False,
                 "ExifExtraction":True,
-                "Quality": 75
+                "Quality": 75,
+                "Engine": "PIL"
                 }
             self.ScaledImages = {
                 "Size":800,
@@ -116,8 +122,11 @@ class Config:
                 "Progressive":False,
                 "Optimize":False,
                 "ExifExtraction":False,
-                "Quality": 75
+                "Quality": 75,
+                "Engine": "PIL"
                 }
+            #Extra downscaled images for exported images, same keys as ScaledImages 
+            self.ExtraImages = {}
             #Video default options
             self.ScratchDir = "/tmp"
             self.VideoBitRate = 600
@@ -188,6 +197,11 @@ class Config:
             elif j == "SynchronizeRep".lower():     self.SynchronizeRep = i[1]
             elif j == "SynchronizeType".lower():    self.SynchronizeType = i[1]
             elif j == "ImageCache".lower():         self.ImageCache = int(i[1])
+            elif j == "ImageCacheMemory".lower():   self.ImageCacheMemory = float(i[1])
+            elif j == "PrefetchDepth".lower():      self.PrefetchDepth = int(i[1])
+            elif j == "NbrWorkers".lower():         self.NbrWorkers = int(i[1])
+            elif j == "MetadataIndexFile".lower():  self.MetadataIndexFile = i[1].strip()
+            elif j == "IncrementalScan".lower():    self.IncrementalScan = configparser.getboolean("Selector", "IncrementalScan")
             elif j == "ImageWidth".lower():         self.ImageWidth = int(i[1])
             elif j == "ImageHeight".lower():        self.ImageHeight = int(i[1])
             elif j == "gimp".lower():               self.Gimp = i[1]
@@ -197,20 +211,17 @@ class Config:
 
 
         for k in ["ScaledImages", "Thumbnails"]:
-            try:
-                dico = eval(k)
-            except:
-                dico = {}
-            for i in configparser.items(k):
-                j = i[0]
-                if j == "Size".lower():dico["Size"] = int(i[1])
-                elif j == "Suffix".lower():dico["Suffix"] = i[1]
-                elif j == "Interpolation".lower():dico["Interpolation"] = int(i[1])
-                elif j == "Progressive".lower():dico["Progressive"] = configparser.getboolean(k, "Progressive")
-                elif j == "Optimize".lower():dico["Optimize"] = configparser.getboolean(k, "Optimize")
-                elif j == "ExifExtraction".lower():dico["ExifExtraction"] = configparser.getboolean(k, "ExifExtraction")
-                elif j == "Quality".lower():dico["Quality"] = int(i[1])
-            exec("self.%s=dico" % k)
+            if configparser.has_section(k):
+                setattr(self, k, self.readRendition(configparser, k, getattr(self, k)))
+
+        #Any other section with a size is an extra rendition made for exported images
+        for k in configparser.sections():
+            if k in ["Selector", "ScaledImages", "Thumbnails", "Video"] or not configparser.has_option(k, "Size"):
+                continue
+            dico = self.readRendition(configparser, k, self.ScaledImages)
+            if not configparser.has_option(k, "Suffix"):
+                dico["Suffix"] = k.lower()
+            self.ExtraImages[k] = dico
 
         #Read Video options
         try:
@@ -236,6 +247,37 @@ class Config:
             logging.warning("No Video section in configuration file !")
 
 
+    def readRendition(self, configparser, section, default):
+        """
+        Read the parameters of a downscaled image (size, suffix, quality, ...) 
+        
+        @param configparser: ConfigParser instance with the files already read
+        @param section: name of the section to read
+        @param default: dictionary with the default values
+        @return: dictionary with the parameters of the rendition
+        """
+        dico = default.copy()
+        for i in configparser.items(section):
+            j = i[0]
+            if j == "Size".lower():dico["Size"] = int(i[1])
+            elif j == "Suffix".lower():dico["Suffix"] = i[1]
+            elif j == "Interpolation".lower():dico["Interpolation"] = int(i[1])
+            elif j == "Progressive".lower():dico["Progressive"] = configparser.getboolean(section, "Progressive")
+            elif j == "Optimize".lower():dico["Optimize"] = configparser.getboolean(section, "Optimize")
+            elif j == "ExifExtraction".lower():dico["ExifExtraction"] = configparser.getboolean(section, "ExifExtraction")
+            elif j == "Quality".lower():dico["Quality"] = int(i[1])
+            elif j == "Engine".lower():dico["Engine"] = i[1].strip()
+        return dico
+
+
+    def getRenditions(self):
+        """
+        @return: the list of parameters of all downscaled images (scaled, thumbnails and extra ones) 
+        to be made for every exported image
+        """
+        return [self.ScaledImages, self.Thumbnails] + [self.ExtraImages[k] for k in sorted(self.ExtraImages)]
+
+
     def __repr__(self):
         logging.debug("Config.__repr__")
         listtxt = ["",
@@ -250,7 +292,8 @@ class Config:
         "Backup media size (CD,DVD):\t  %s MByte" % self.MediaSize,
         "Scaled imagesSize:\t\t  %s pixels in the largest dimension" % self.ScaledImages["Size"],
         "Thumbnail Size:\t\t\t  %s pixels in the largest dimension" % self.Thumbnails["Size"],
-        "Caching of %s images " % self.ImageCache
+        "Caching of %s images " % self.ImageCache,
+        "Memory for the cache of images:\t  %s MByte" % self.ImageCacheMemory
         ]
         return  os.linesep.join(listtxt)
 
@@ -311,6 +354,11 @@ class Config:
         "#Remote repository to synchronize with (rsync like)", "SynchronizeRep: %s" % self.SynchronizeRep, "",
         "#Synchronization type, acceptable values are Newer, Older, Selected and All", "SynchronizeType: %s" % self.SynchronizeType, "",
         "#Allow the creation of a Cache of images with the given size in number of images", "ImageCache: %s" % self.ImageCache, "",
+        "#Memory allowed for the cache of images (in MegaByte), 0 for no limit", "ImageCacheMemory: %s" % self.ImageCacheMemory, "",
+        "#Number of images to decode in advance in the direction of browsing, 0 to disable", "PrefetchDepth: %s" % self.PrefetchDepth, "",
+        "#Number of processes used to export selected images, 0 for one per processor, 1 to disable", "NbrWorkers: %s" % self.NbrWorkers, "",
+        "#Database indexing the metadata of all images, at the root of the repository (empty to disable)", "MetadataIndexFile: %s" % self.MetadataIndexFile, "",
+        "#Only list again the directories modified since the last start-up (needs the metadata index)", "IncrementalScan: %s" % self.IncrementalScan, "",
         "#Gnu Image Manipulation Program (GIMP) path to executable", "Gimp: %s" % self.Gimp, "",
         "#Digital Camera Raw (dcraw) extraction program and option (-w -c is  suggested)", "Dcraw: %s" % self.Dcraw, "",
         "#Filter selected by default for image processing: ContrastMask, AutoWB, ...", "SelectedFilter: %s" % self.SelectedFilter, ""]
@@ -320,9 +368,12 @@ class Config:
             lsttxt += ["#Height of the last image displayed ... should not be modified", "ImageHeight:%s" % self.ImageHeight, ""]
 
 
-        for i in ["ScaledImages", "Thumbnails"]:
+        for i in ["ScaledImages", "Thumbnails"] + sorted(self.ExtraImages):
             lsttxt += ["[%s]" % i, ""]
-            j = eval("self.%s" % i)
+            if i in self.ExtraImages:
+                j = self.ExtraImages[i]
+            else:
+                j = eval("self.%s" % i)
             lsttxt += ["#%s size" % i, "Size: %s" % j["Size"], ""]
             lsttxt += ["#%s suffix" % i, "Suffix: %s" % j["Suffix"], ""]
             lsttxt += ["#%s downsampling quality [0=nearest, 1=antialias 2=bilinear, 3=bicubic]" % i, "Interpolation: %s" % j["Interpolation"], ""]
@@ -330,6 +381,7 @@ class Config:
             lsttxt += ["#%s optimized JPEG (2 pass encoding)" % i, "Optimize: %s" % j["Optimize"], ""]
             lsttxt += ["#%s quality (in percent)" % i, "Quality: %s" % j["Quality"], ""]
             lsttxt += ["#%s image can be obtained by Exif extraction ?" % i, "ExifExtraction: %s" % j["ExifExtraction"], ""]
+            lsttxt += ["#%s made by PIL or by libexiftran (faster, JPEG only, interpolation ignored)" % i, "Engine: %s" % j.get("Engine", "PIL"), ""]
 
         lsttxt += ["[Video]",
             "#Directory where you want PBS to work? (/tmp)", "ScratchDir: %s" % self.ScratchDir, "",
@@ -24,69 +24,43 @@
 #*
 #*****************************************************************************/
 __author__ = "Jérôme Kieffer"
-__date__ = "23 Feb 2011"
+__date__ = "18 Oct 2012"
 __copyright__ = "Jerome Kieffer"
 __license__ = "GPLv3+"
 __contact__ = "Jerome.Kieffer@terre-adelie.org"
 
-def unicode2ascii(_unicrap):
-    """
-    This takes a UNICODE string and replaces unicode characters with
-    something equivalent in 7-bit ASCII. It returns a plain ASCII string. 
-    This function makes a best effort to convert unicode characters into 
-    ASCII equivalents. It does not just strip out the Latin-1 characters.
-    All characters in the standard 7-bit ASCII range are preserved. 
-    In the 8th bit range all the Latin-1 accented letters are converted 
-    to unaccented equivalents. Most symbol characters are converted to 
-    something meaningful. Anything not converted is deleted.
-    """
-    xlate = {0xc0:'A', 0xc1:'A', 0xc2:'A', 0xc3:'A', 0xc4:'A', 0xc5:'A',
-        0xc6:'Ae', 0xc7:'C',
-        0xc8:'E', 0xc9:'E', 0xca:'E', 0xcb:'E',
-        0xcc:'I', 0xcd:'I', 0xce:'I', 0xcf:'I',
-        0xd0:'Th', 0xd1:'N',
-        0xd2:'O', 0xd3:'O', 0xd4:'O', 0xd5:'O', 0xd6:'O', 0xd8:'O',
-        0xd9:'U', 0xda:'U', 0xdb:'U', 0xdc:'U',
-        0xdd:'Y', 0xde:'th', 0xdf:'ss',
-        0xe0:'a', 0xe1:'a', 0xe2:'a', 0xe3:'a', 0xe4:'a', 0xe5:'a',
-        0xe6:'ae', 0xe7:'c',
-        0xe8:'e', 0xe9:'e', 0xea:'e', 0xeb:'e',
-        0xec:'i', 0xed:'i', 0xee:'i', 0xef:'i',
-        0xf0:'th', 0xf1:'n',
-        0xf2:'o', 0xf3:'o', 0xf4:'o', 0xf5:'o', 0xf6:'o', 0xf8:'o',
-        0xf9:'u', 0xfa:'u', 0xfb:'u', 0xfc:'u',
-        0xfd:'y', 0xfe:'th', 0xff:'y',
-        0xa1:'!', 0xa2:'{cent}', 0xa3:'{pound}', 0xa4:'{currency}',
-        0xa5:'{yen}', 0xa6:'|', 0xa7:'{section}', 0xa8:'{umlaut}',
-        0xa9:'{C}', 0xaa:'{^a}', 0xab:'<<', 0xac:'{not}',
-        0xad:'-', 0xae:'{R}', 0xaf:'_', 0xb0:'{degrees}',
-        0xb1:'{+/-}', 0xb2:'{^2}', 0xb3:'{^3}', 0xb4:"'",
-        0xb5:'{micro}', 0xb6:'{paragraph}', 0xb7:'*', 0xb8:'{cedilla}',
-        0xb9:'{^1}', 0xba:'{^o}', 0xbb:'>>',
-        0xbc:'{1/4}', 0xbd:'{1/2}', 0xbe:'{3/4}', 0xbf:'?',
-        0xd7:'*', 0xf7:'/'
-        }
+import re
 
-    s = ""
-    for i in _unicrap:
-        ordi = ord(i)
-        if ordi in xlate:
-            s += xlate[ordi]
-        elif ordi >= 0x80:
-            pass
-        else:
-            s += str(i)
-    return s
+#Latin-1 characters and their equivalent in 7-bit ASCII
+ASCII_XLATE = {0xc0:'A', 0xc1:'A', 0xc2:'A', 0xc3:'A', 0xc4:'A', 0xc5:'A',
+    0xc6:'Ae', 0xc7:'C',
+    0xc8:'E', 0xc9:'E', 0xca:'E', 0xcb:'E',
+    0xcc:'I', 0xcd:'I', 0xce:'I', 0xcf:'I',
+    0xd0:'Th', 0xd1:'N',
+    0xd2:'O', 0xd3:'O', 0xd4:'O', 0xd5:'O', 0xd6:'O', 0xd8:'O',
+    0xd9:'U', 0xda:'U', 0xdb:'U', 0xdc:'U',
+    0xdd:'Y', 0xde:'th', 0xdf:'ss',
+    0xe0:'a', 0xe1:'a', 0xe2:'a', 0xe3:'a', 0xe4:'a', 0xe5:'a',
+    0xe6:'ae', 0xe7:'c',
+    0xe8:'e', 0xe9:'e', 0xea:'e', 0xeb:'e',
+    0xec:'i', 0xed:'i', 0xee:'i', 0xef:'i',
+    0xf0:'th', 0xf1:'n',
+    0xf2:'o', 0xf3:'o', 0xf4:'o', 0xf5:'o', 0xf6:'o', 0xf8:'o',
+    0xf9:'u', 0xfa:'u', 0xfb:'u', 0xfc:'u',
+    0xfd:'y', 0xfe:'th', 0xff:'y',
+    0xa1:'!', 0xa2:'{cent}', 0xa3:'{pound}', 0xa4:'{currency}',
+    0xa5:'{yen}', 0xa6:'|', 0xa7:'{section}', 0xa8:'{umlaut}',
+    0xa9:'{C}', 0xaa:'{^a}', 0xab:'<<', 0xac:'{not}',
+    0xad:'-', 0xae:'{R}', 0xaf:'_', 0xb0:'{degrees}',
+    0xb1:'{+/-}', 0xb2:'{^2}', 0xb3:'{^3}', 0xb4:"'",
+    0xb5:'{micro}', 0xb6:'{paragraph}', 0xb7:'*', 0xb8:'{cedilla}',
+    0xb9:'{^1}', 0xba:'{^o}', 0xbb:'>>',
+    0xbc:'{1/4}', 0xbd:'{1/2}', 0xbe:'{3/4}', 0xbf:'?',
+    0xd7:'*', 0xf7:'/'
+    }
 
-
-def unicode2html(_unicrap):
-    """
-    Converts an unicode input into a "html" like string
-    
-    @param _unicrap: input unicode
-    @return: html string
-    """
-    xlate = {u'\u0022': '&quot;',
+#Characters and their HTML entities
+HTML_XLATE = {u'\u0022': '&quot;',
 u'\u0026': '&amp;',
 u'\u0027': '&apos;',
 u'\u003C': '&lt;',
@@ -340,11 +314,84 @@ u'\u2663': '&clubs;',
 u'\u2665': '&hearts;',
 u'\u2666': '&diams;'}
 
-    strOut = ""
-    if _unicrap is not None:
-        for i in _unicrap:
-            if i in xlate:
-                strOut += xlate[i]
-            else:
-                strOut += str(i)
-    return strOut
+#Translation tables for unicode.translate
+ASCII_TABLE = dict((key, unicode(value)) for key, value in ASCII_XLATE.items())
+HTML_TABLE = dict((ord(key), unicode(value)) for key, value in HTML_XLATE.items())
+#HTML special characters in the 7-bit range, for plain strings
+HTML_ASCII_RE = re.compile("|".join(re.escape(str(key)) for key in HTML_XLATE if ord(key) < 0x80))
+#Separator used to translate many unicode strings at once
+SEPARATOR = u"\x00"
+
+
+def unicode2ascii(_unicrap):
+    """
+    This takes a UNICODE string and replaces unicode characters with
+    something equivalent in 7-bit ASCII. It returns a plain ASCII string. 
+    This function makes a best effort to convert unicode characters into 
+    ASCII equivalents. It does not just strip out the Latin-1 characters.
+    All characters in the standard 7-bit ASCII range are preserved. 
+    In the 8th bit range all the Latin-1 accented letters are converted 
+    to unaccented equivalents. Most symbol characters are converted to 
+    something meaningful. Anything not converted is deleted.
+    """
+    if isinstance(_unicrap, str):
+        _unicrap = _unicrap.decode("latin1")
+    return _unicrap.translate(ASCII_TABLE).encode("ascii", "ignore")
+
+
+def unicode2html(_unicrap):
+    """
+    Converts an unicode input into a "html" like string
+    
+    @param _unicrap: input unicode
+    @return: html string
+    """
+    if _unicrap is None:
+        return ""
+    if isinstance(_unicrap, str):
+        return HTML_ASCII_RE.sub(lambda match: HTML_XLATE[unicode(match.group())], _unicrap)
+    return str(_unicrap.translate(HTML_TABLE))
+
+
+def translateMany(table, lstStr):
+    """
+    Translate a list of unicode strings with a single call to unicode.translate
+    
+    @param table: translation table
+    @param lstStr: list of strings
+    @return: list of unicode strings or None if the strings cannot be joined
+    """
+    if not lstStr:
+        return []
+    if not all(isinstance(i, unicode) for i in lstStr):
+        return None
+    joined = SEPARATOR.join(lstStr)
+    if joined.count(SEPARATOR) != max(0, len(lstStr) - 1):
+        return None
+    return joined.translate(table).split(SEPARATOR)
+
+
+def unicode2asciiList(lstStr):
+    """
+    Batch version of unicode2ascii
+    
+    @param lstStr: list of unicode (or latin-1) strings
+    @return: list of ASCII strings
+    """
+    result = translateMany(ASCII_TABLE, lstStr)
+    if result is None:
+        return [unicode2ascii(i) for i in lstStr]
+    return [i.encode("ascii", "ignore") for i in result]
+
+
+def unicode2htmlList(lstStr):
+    """
+    Batch version of unicode2html
+    
+    @param lstStr: list of unicode strings
+    @return: list of html strings
+    """
+    result = translateMany(HTML_TABLE, lstStr)
+    if result is None:
+        return [unicode2html(i) for i in lstStr]
+    return [str(i) for i in result]
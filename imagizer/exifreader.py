@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#* $Source$
+#* $Id$
+#*
+#* Copyright (C) 2006 - 2012,  Jérôme Kieffer <imagizer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#* This program is free software; you can redistribute it and/or modify
+#* it under the terms of the GNU General Public License as published by
+#* the Free Software Foundation; either version 2 of the License, or
+#* (at your option) any later version.
+#*
+#* This program is distributed in the hope that it will be useful,
+#* but WITHOUT ANY WARRANTY; without even the implied warranty of
+#* MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#* GNU General Public License for more details.
+#*
+#* You should have received a copy of the GNU General Public License
+#* along with this program; if not, write to the Free Software
+#* Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#*
+#*****************************************************************************/
+
+"""
+Lightweight reader for the few EXIF tags displayed by selector.
+
+Only the header of the JPEG file is read, up to the start of the scan (SOS):
+the EXIF block (APP1 segment), the JPEG comment (COM segment) and the size
+of the image (SOF segment). Values are presented like exiv2 does (human_value
+of pyexiv2), and memoized per file, modification time and size.
+For writing metadata or reading other tags, use pyexiv2 via imagizer.exif.
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import os, logging, struct, threading
+from collections import OrderedDict
+logger = logging.getLogger("imagizer.exifreader")
+
+#Tags read, by IFD: tag number -> key as in pyexiv2
+IFD0_TAGS = {0x010f: "Exif.Image.Make",
+             0x0110: "Exif.Image.Model",
+             0x0112: "Exif.Image.Orientation",
+             0x4746: "Exif.Image.Rating"}
+EXIF_TAGS = {0x829a: "Exif.Photo.ExposureTime",
+             0x829d: "Exif.Photo.FNumber",
+             0x8827: "Exif.Photo.ISOSpeedRatings",
+             0x9003: "Exif.Photo.DateTimeOriginal",
+             0x9204: "Exif.Photo.ExposureBiasValue",
+             0x9209: "Exif.Photo.Flash",
+             0x920a: "Exif.Photo.FocalLength",
+             0xa002: "Exif.Photo.PixelXDimension",
+             0xa003: "Exif.Photo.PixelYDimension"}
+EXIF_IFD_POINTER = 0x8769
+
+#TIFF types: size and struct format of one value
+TYPES = {1: (1, "B"), 2: (1, "s"), 3: (2, "H"), 4: (4, "L"), 5: (8, "LL"),
+         6: (1, "b"), 7: (1, "s"), 8: (2, "h"), 9: (4, "l"), 10: (8, "ll")}
+
+FLASH = {0x00: "No flash", 0x01: "Fired", 0x05: "Fired, return light not detected",
+         0x07: "Fired, return light detected", 0x08: "Yes, did not fire",
+         0x09: "Yes, compulsory", 0x0d: "Yes, compulsory, return light not detected",
+         0x0f: "Yes, compulsory, return light detected", 0x10: "No, compulsory",
+         0x14: "No, did not fire, return not detected", 0x18: "No, auto",
+         0x19: "Yes, auto", 0x1d: "Yes, auto, return light not detected",
+         0x1f: "Yes, auto, return light detected", 0x20: "No flash function",
+         0x30: "No, no flash function", 0x41: "Yes, red-eye reduction",
+         0x45: "Yes, red-eye reduction, return light not detected",
+         0x47: "Yes, red-eye reduction, return light detected",
+         0x49: "Yes, compulsory, red-eye reduction",
+         0x4d: "Yes, compulsory, red-eye reduction, return light not detected",
+         0x4f: "Yes, compulsory, red-eye reduction, return light detected",
+         0x50: "No, red-eye reduction", 0x58: "No, auto, red-eye reduction",
+         0x59: "Yes, auto, red-eye reduction",
+         0x5d: "Yes, auto, red-eye reduction, return light not detected",
+         0x5f: "Yes, auto, red-eye reduction, return light detected"}
+
+#Start Of Frame markers (giving the size of the image)
+SOF_MARKERS = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+#Memo of the headers already read: (filename, mtime, size) -> header
+maxCache = 1024
+cache = OrderedDict()
+lock = threading.Lock()
+
+
+def parseIFD(tiff, offset, endian, tags, header):
+    """
+    Read the tags of interest of an IFD
+
+    @param tiff: TIFF block (string)
+    @param offset: offset of the IFD in the block
+    @param endian: "<" or ">"
+    @param tags: dictionary tag number -> key
+    @param header: dictionary filled with key -> value
+    @return: offset of the Exif sub-IFD if any
+    """
+    subIFD = None
+    nbEntries = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+    for i in range(nbEntries):
+        entry = offset + 2 + 12 * i
+        tag, typ, count = struct.unpack(endian + "HHL", tiff[entry:entry + 8])
+        if tag == EXIF_IFD_POINTER:
+            subIFD = struct.unpack(endian + "L", tiff[entry + 8:entry + 12])[0]
+            continue
+        if (tag not in tags) or (typ not in TYPES):
+            continue
+        size, fmt = TYPES[typ]
+        if size * count > 4:
+            start = struct.unpack(endian + "L", tiff[entry + 8:entry + 12])[0]
+        else:
+            start = entry + 8
+        raw = tiff[start:start + size * count]
+        if len(raw) != size * count:
+            continue
+        if fmt == "s":
+            header[tags[tag]] = raw.split("\x00")[0]
+        else:
+            values = struct.unpack(endian + fmt * count, raw)
+            if len(fmt) == 2:
+                values = zip(values[::2], values[1::2])
+            header[tags[tag]] = values[0] if count == 1 else list(values)
+    return subIFD
+
+
+def parseExif(data):
+    """
+    Parse the content of an APP1 segment
+
+    @param data: the segment, starting with "Exif\\0\\0"
+    @return: dictionary key -> value (numbers, 2-tuples for rationals or strings)
+    """
+    header = {}
+    tiff = data[6:]
+    if tiff[:2] == "II":
+        endian = "<"
+    elif tiff[:2] == "MM":
+        endian = ">"
+    else:
+        return header
+    offset = struct.unpack(endian + "L", tiff[4:8])[0]
+    subIFD = parseIFD(tiff, offset, endian, IFD0_TAGS, header)
+    if subIFD:
+        parseIFD(tiff, subIFD, endian, EXIF_TAGS, header)
+    return header
+
+
+def readHeader(filename):
+    """
+    Read the header of a JPEG file, up to the start of the scan
+
+    @param filename: path of the file
+    @return: dictionary with the EXIF tags (keys as in pyexiv2), "comment",
+            "width" and "height", or None if the file is not a readable JPEG
+    """
+    header = {"comment": ""}
+    exifRead = False
+    with open(filename, "rb") as f:
+        if f.read(2) != "\xff\xd8":
+            return None
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4 or marker[0] != "\xff":
+                break
+            code = ord(marker[1])
+            if code == 0xff:
+                #fill byte
+                f.seek(-3, os.SEEK_CUR)
+                continue
+            length = struct.unpack(">H", marker[2:])[0] - 2
+            if code in (0xda, 0xd9) or length < 0:
+                break
+            if code == 0xe1:
+                data = f.read(length)
+                if data.startswith("Exif\x00\x00") and not exifRead:
+                    header.update(parseExif(data))
+                    exifRead = True
+            elif code == 0xfe:
+                header["comment"] = f.read(length)
+            elif code in SOF_MARKERS:
+                data = f.read(length)
+                if len(data) >= 5:
+                    header["height"], header["width"] = struct.unpack(">HH", data[1:5])
+            else:
+                f.seek(length, os.SEEK_CUR)
+    return header
+
+
+def read(filename):
+    """
+    Read the header of a JPEG file, memoized per file, modification time and size
+
+    @param filename: path of the file
+    @return: dictionary as from readHeader or None (it must not be modified)
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    key = (filename, stat.st_mtime, stat.st_size)
+    with lock:
+        if key in cache:
+            header = cache.pop(key)
+            cache[key] = header
+            return header
+    try:
+        header = readHeader(filename)
+    except (IOError, struct.error, IndexError) as error:
+        logger.warning("Unable to read the header of %s: %s" % (filename, error))
+        header = None
+    with lock:
+        cache[key] = header
+        while len(cache) > maxCache:
+            cache.popitem(last=False)
+    return header
+
+
+def gcd(a, b):
+    """greatest common divisor"""
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def humanValue(key, value):
+    """
+    Present a value like exiv2 does (i.e. human_value in pyexiv2)
+
+    @param key: key of the tag
+    @param value: value as returned by parseExif
+    @return: string
+    """
+    if isinstance(value, list):
+        if key == "Exif.Photo.ISOSpeedRatings":
+            return " ".join([str(i) for i in value])
+        value = value[0]
+    if key == "Exif.Photo.ExposureTime":
+        num, den = value
+        if num > 1 and den > 1 and den >= num:
+            den = int(float(den) / num + 0.5)
+            num = 1
+        if den > 1 and den < num:
+            num = int(float(num) / den + 0.5)
+            den = 1
+        if den == 1:
+            return "%s s" % num
+        return "%s/%s s" % (num, den)
+    elif key == "Exif.Photo.FNumber":
+        num, den = value
+        if den == 0:
+            return "(%s/%s)" % (num, den)
+        return "F%.2g" % (float(num) / den)
+    elif key == "Exif.Photo.FocalLength":
+        num, den = value
+        if den == 0:
+            return "(%s/%s)" % (num, den)
+        return "%.1f mm" % (float(num) / den)
+    elif key == "Exif.Photo.ExposureBiasValue":
+        num, den = value
+        if den <= 0:
+            return "(%s/%s)" % (num, den)
+        if num == 0:
+            return "0 EV"
+        d = gcd(abs(num), den)
+        if den // d == 1:
+            return "%s%s EV" % ("-" if num < 0 else "+", abs(num) // d)
+        return "%s%s/%s EV" % ("-" if num < 0 else "+", abs(num) // d, den // d)
+    elif key == "Exif.Photo.Flash":
+        return FLASH.get(value, "(%s)" % value)
+    return str(value).strip()
@@ -46,7 +46,7 @@ __contact__ = "imagizer@terre-adelie.org"
 __date__ = "20111016"
 __license__ = "GPL"
 
-import os, threading, logging
+import os, threading, logging, tempfile
 
 installdir = os.path.dirname(__file__)
 
@@ -147,6 +147,95 @@ class Exiftran(object):
         myThread.start()
 
 
+    @staticmethod
+    def transformFile(action, filename):
+        """
+        Lossless transformation of a file done in memory with libexiftran: 
+        the file is read once, transformed and replaced atomically 
+        (keeping its permissions and its modification time).
+        Without libexiftran, the file is transformed in the background with exiftran.
+        
+        @param action: 0 for autorotate, 1 for 180 deg, 2 for 270 deg and 9 for 90 deg reotation clockwise 
+        @type action: integer
+        @param filename: name of the jpeg file to process
+        @type filename: string
+        @return: the new content of the file, or None if the processing is done in the background
+        """
+        logging.debug("Exiftran.transformFile %s %s" % (action, filename))
+        Exiftran.semaphore.acquire()
+        if exiftranExe is not None:
+            myThread = threading.Thread(target=Exiftran._exiftranThread, args=(action, filename))
+            myThread.start()
+            return
+        try:
+            with open(filename, "rb") as f:
+                data = libexiftran.transform(action, f.read())
+            stat = os.stat(filename)
+            fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", dir=os.path.dirname(filename))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                os.fchmod(fd, stat.st_mode)
+                try:
+                    os.fchown(fd, stat.st_uid, stat.st_gid)
+                except OSError:
+                    logging.warning("Exiftran.transformFile: unable to chown %s" % tmpfile)
+            os.utime(tmpfile, (stat.st_atime, stat.st_mtime))
+            try:
+                os.rename(tmpfile, filename)
+            except OSError:
+                os.unlink(tmpfile)
+                raise
+        finally:
+            Exiftran.semaphore.release()
+        return data
+
+
+    @staticmethod
+    def thumbnail(filename, strThumbFile, Size=160, Quality=75, Progressive=False, Optimize=False):
+        """
+        Make a thumbnail of a JPEG file with the C code of libexiftran, 
+        which decodes the image at reduced size without holding the GIL.
+        
+        @param filename: name of the JPEG file 
+        @param strThumbFile: name of the thumbnail file to write
+        @param Size: size of the largest side of the thumbnail
+        @param Quality: JPEG quality in percent
+        @param Progressive: write a progressive JPEG
+        @param Optimize: optimize the Huffman tables
+        @return: True if the thumbnail was written, False if libexiftran is not available or failed
+        """
+        if (exiftranExe is not None) or not hasattr(libexiftran, "thumbnail"):
+            return False
+        try:
+            libexiftran.thumbnail(filename, int(Size), int(Quality), int(bool(Progressive)), int(bool(Optimize)), strThumbFile)
+        except (libexiftran.error, IOError) as error:
+            logging.warning("Exiftran.thumbnail failed on %s: %s" % (filename, error))
+            return False
+        return True
+
+
+    @staticmethod
+    def batch(lstActions, nbThreads=0):
+        """
+        Process many files at once and wait for the end of the processing.
+        With libexiftran, the files are transformed by a pool of threads 
+        without holding the GIL, else exiftran is called for each file.
+        
+        @param lstActions: list of 2-tuple (action, filename), with action being
+                0 for autorotate, 1 for 180 deg, 2 for 270 deg and 9 for 90 deg reotation clockwise
+        @param nbThreads: number of threads, 0 for one per processor
+        @return: list of return codes, 0 for success 
+        """
+        logging.debug("Exiftran.batch %s files" % len(lstActions))
+        if exiftranExe is None:
+            return libexiftran.run_batch([(int(action), str(filename)) for action, filename in lstActions], nbThreads)
+        lstRet = []
+        for action, filename in lstActions:
+            if action == 0:action = "a"
+            lstRet.append(os.system('%s -ip -%s "%s" ' % (exiftranExe, action, filename)))
+        return lstRet
+
+
     @staticmethod
     def getSemaphoreValue():
         """return the value of the semaphore, either 0 or 1"""
@@ -33,13 +33,14 @@ __licence__ = "GPLv2"
 __contact__ = "imagizer@terre-adelie.org"
 
 
-import os, logging
+import os, logging, time
 import os.path as op
 installdir = op.dirname(__file__)
 logger = logging.getLogger("imagizer.fileutils")
 
 from config import Config
 config = Config()
+from metadataindex import MetadataIndex
 
 
 def makedir(filen):
@@ -92,7 +93,62 @@ def findFiles(strRootDir, lstExtentions=None, bFromRoot=False):
 
 
 
-
+def scanFiles(strRootDir, lstExtentions=None):
+    """
+    Incremental equivalent of findFiles: the content of every directory is 
+    remembered in the MetadataIndex with the modification time of the directory,
+    and only directories modified since the last scan are listed again.
+    Falls back on findFiles when the index is disabled.
+    
+    @param strRootDir: path of the root of the search
+    @type strRootDir: string
+    @param lstExtentions: list of string representing interesting extensions
+    @return: the list of the files with the given suffix in the given dir, starting from strRootDir
+    @rtype: list of strings 
+    """
+    if lstExtentions is None:
+        lstExtentions = config.Extensions
+    index = MetadataIndex()
+    if (index.getConnection() is None) or (op.abspath(strRootDir) != op.abspath(config.DefaultRepository)):
+        return findFiles(strRootDir, lstExtentions)
+    listFiles = []
+    #directories modified within the resolution of the timestamps could be modified again unnoticed
+    recent = time.time() - 2
+    toScan = [""]
+    nbListed = 0
+    while toScan:
+        dirname = toScan.pop()
+        fullPath = op.join(strRootDir, dirname)
+        try:
+            mtime = os.stat(fullPath).st_mtime
+        except OSError:
+            logger.warning("Unable to stat directory %s" % fullPath)
+            continue
+        cached = index.getDirectory(dirname)
+        if (cached is not None) and (cached[0] == mtime):
+            files, subdirs = cached[1], cached[2]
+        else:
+            nbListed += 1
+            files = []
+            subdirs = []
+            for oneFile in os.listdir(fullPath):
+                fullName = op.join(fullPath, oneFile)
+                if op.isdir(fullName):
+                    #like os.walk, do not follow symbolic links
+                    if not op.islink(fullName):
+                        subdirs.append(oneFile)
+                else:
+                    files.append(oneFile)
+            if mtime < recent:
+                index.putDirectory(dirname, mtime, files, subdirs)
+        for oneFile in files:
+            if op.splitext(oneFile)[1].lower() in lstExtentions:
+                listFiles.append(op.join(dirname, oneFile))
+        for subdir in subdirs:
+            toScan.append(op.join(dirname, subdir))
+    index.commit()
+    logger.debug("scanFiles: %i directories listed for %i files" % (nbListed, len(listFiles)))
+    return listFiles
 
 
 def smartSize(size):
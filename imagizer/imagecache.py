@@ -27,51 +27,87 @@
 """
 ImageCache is a class containing a copy of the bitmap of images .
 Technically it is a Borg (design Pattern) so every instance of ImageCache has exactly the same contents.
+
+The cache is a Least Recently Used (LRU) one, built on an OrderedDict so that
+touching, inserting and evicting an image are all O(1).
+Eviction happens either when the number of images or when the memory used by
+the bitmaps exceeds the limits.
+The cache is protected by a lock as it is populated by the prefetching thread.
 """
 __author__ = "Jérôme Kieffer"
 __contact__ = "imagizer@terre-adelie.org"
-__date__ = "20111016"
+__date__ = "20121018"
 __license__ = "GPL"
 
-import logging, os
+import logging, os, threading
+from collections import OrderedDict
 logger = logging.getLogger("imagizer.imagecache")
 from config import Config
 config = Config()
 
 
+def sizeof(value):
+    """
+    Estimate the memory footprint of the bitmaps held by a cached object
+    (i.e. the scaledPixbuffer and the PIL image of a Photo instance)
+
+    @param value: object stored in the cache
+    @return: size in bytes
+    @rtype: integer
+    """
+    size = 0
+    pixbuf = getattr(value, "scaledPixbuffer", None)
+    if pixbuf is not None:
+        try:
+            size += pixbuf.get_rowstride() * pixbuf.get_height()
+        except AttributeError:
+            logger.debug("sizeof: not a pixbuf %s" % pixbuf)
+    pil = getattr(value, "_pil", None)
+    if pil is not None:
+        try:
+            size += pil.size[0] * pil.size[1] * len(pil.getbands())
+        except AttributeError:
+            logger.debug("sizeof: not a PIL image %s" % pil)
+    return size
+
+
 ################################################################################################
 ###############  Class ImageCache for storing the bitmaps in a Borg ############################
 ################################################################################################
 class ImageCache(dict):
     """
     this class is a Borg : always returns the same values regardless to the instance of the object
-    it is used as data storage for images ... with a limit on the number of images to keep in memory.
+    it is used as data storage for images ... with a limit on the number of images 
+    and on the memory (in bytes) to keep in memory.
     """
     __shared_state = {}
     __data_initialized = False
 
 
-    def __init__(self, maxSize=100):
+    def __init__(self, maxSize=100, maxMemory=0):
         """
         Constructor of ImageCache
         @param maxSize: number of element to keep in memory
+        @param maxMemory: memory budget for the bitmaps in bytes, 0 for no limit
         """
         self.__dict__ = self.__shared_state
         if  ImageCache.__data_initialized is False:
             ImageCache.__data_initialized = True
             logger.debug("ImageCache.__init__: initalization of the Borg")
-            self.ordered = []
-            self.imageDict = {}
+            self.ordered = OrderedDict()
+            self.sizes = {}
             self.maxSize = maxSize
+            self.maxMemory = maxMemory
             self.size = 0
+            self.lock = threading.RLock()
 
 
     def __repr__(self):
         """
         """
         out = ["{"]
-        for key in self.ordered:
-            out.append(" '%s': %s," % (key, self.imageDict[key]))
+        for key, value in self.ordered.iteritems():
+            out.append(" '%s': %s," % (key, value))
         out.append("}")
         return os.linesep.join(out)
 
@@ -79,35 +115,37 @@ class ImageCache(dict):
     def __setitem__(self, key, value):
         """
         x.__setitem__(i, y) <==> x[i]=y
+        
+        Setting an existing key again updates its memory footprint,
+        this is how images report the bitmaps they have loaded. 
         """
         logger.debug("ImageCache.__setitem__: %s" % key)
-        self.imageDict[ key ] = value
-        if key in self.ordered:
-            index = self.ordered.index(key)
-            self.ordered.pop(index)
-        if len(self.ordered) > self.maxSize:
-            firstKey = self.ordered.pop(0)
-            logger.debug("Removing from cache: %s" % firstKey)
-            self.imageDict.pop(firstKey)
-        self.ordered.append(key)
+        with self.lock:
+            if key in self.ordered:
+                self.ordered.pop(key)
+                self.size -= self.sizes.pop(key)
+            self.ordered[key] = value
+            self.sizes[key] = sizeof(value)
+            self.size += self.sizes[key]
+            self.evict()
 
 
     def __getitem__(self, key):
         """
         x.__getitem__(y) <==> x[y]
         """
-        logger.debug("ImageCache.__setitem__: %s" % key)
-        index = self.ordered.index(key)
-        self.ordered.pop(index)
-        self.ordered.append(key)
-        return self.imageDict[ key ]
+        logger.debug("ImageCache.__getitem__: %s" % key)
+        with self.lock:
+            value = self.ordered.pop(key)
+            self.ordered[key] = value
+            return value
 
 
     def __contains__(self, key):
         """
         D.__contains__(k) -> True if D has a key k, else False
         """
-        return key in self.imageDict
+        return key in self.ordered
     has_key = __contains__
 
 
@@ -117,15 +155,31 @@ class ImageCache(dict):
         return len(self.ordered)
 
 
+    def evict(self):
+        """
+        Remove the least recently used images until the cache fits in 
+        both the number of images and the memory budget.
+        The most recently used image is always kept.
+        """
+        with self.lock:
+            while len(self.ordered) > 1 and \
+                  ((len(self.ordered) > self.maxSize) or (self.maxMemory and self.size > self.maxMemory)):
+                firstKey, _ = self.ordered.popitem(last=False)
+                self.size -= self.sizes.pop(firstKey)
+                logger.debug("Removing from cache: %s" % firstKey)
+
+
     def get(self, key, default=None):
         """
-        get method with default answer implemented
+        Atomic lookup, safe while the prefetch thread inserts (and evicts) images:
+        returns the value, considered as the most recently used, or default.
         """
-        if key in self.ordered:
-            return self.__getitem__(key)
-        elif default is not None:
-            self.__setitem__(key, default)
-            return default
+        with self.lock:
+            if key not in self.ordered:
+                return default
+            value = self.ordered.pop(key)
+            self.ordered[key] = value
+            return value
 
 
     def keys(self):
@@ -133,32 +187,38 @@ class ImageCache(dict):
         Returns the list of keys, ordered
         """
         logger.debug("ImageCache.keys")
-        return self.ordered[:]
+        with self.lock:
+            return self.ordered.keys()
 
 
-    def pop(self, key):
+    def pop(self, key, *default):
         """
-        Remove a key for the dictionary and return it's value
+        Remove a key for the dictionary and return it's value,
+        or default if given and the key is not present (i.e. already evicted)
         """
         logger.debug("ImageCache.pop %s" % key)
-        try:
-            index = self.ordered.index(key)
-        except:
-            raise KeyError
-        self.ordered.pop(index)
-        myData = self.imageDict.pop(key)
-        return myData
+        with self.lock:
+            if key not in self.ordered:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            self.size -= self.sizes.pop(key)
+            return self.ordered.pop(key)
+
 
     def rename(self, oldKey, newKey):
         """
         Change the name of a key without affecting anything else
         If the name is not present: do nothing.
+        
+        The renamed image is considered as the most recently used.
         """
         logger.debug("ImageCache.rename %s->%s" % (oldKey, newKey))
-        if oldKey not in self.ordered:
-            return
-        index = self.ordered.index(oldKey)
-        self.ordered[index] = newKey
-        myData = self.imageDict.pop(oldKey)
-        self.imageDict[newKey] = myData
+        with self.lock:
+            if oldKey not in self.ordered:
+                return
+            if newKey in self.ordered:
+                self.pop(newKey)
+            self.ordered[newKey] = self.ordered.pop(oldKey)
+            self.sizes[newKey] = self.sizes.pop(oldKey)
 
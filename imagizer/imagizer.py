@@ -32,7 +32,7 @@ __author__ = "Jérôme Kieffer"
 __contact__ = "imagizer@terre-adelie.org"
 __date__ = "20111016"
 __license__ = "GPL"
-import os, sys, shutil, time, re, gc, logging
+import os, sys, shutil, time, re, gc, logging, multiprocessing
 logger = logging.getLogger("imagizer.imagizer")
 
 
@@ -64,6 +64,9 @@ from config import Config
 config = Config()
 import fileutils
 from photo import Photo, Signature
+from prefetch import Prefetcher
+from metadatawriter import MetadataWriter
+from exiftran import Exiftran
 
 def gtkFlush():
     """
@@ -120,15 +123,15 @@ class ModelProcessSelected(object):
         @param lstFiles: list of files to process
         """
 
-        def splitIntoPages(pathday, globalCount):
+        def splitIntoPages(pathday):
             """Split a directory (pathday) into pages of 20 images (see config.NbrPerPage)
             
             @param pathday:
-            @param globalCount:
-            @return: the number of images for current page   
+            @return: the list of images to scale   
             """
-            logger.debug("In splitIntoPages %s %s", pathday, globalCount)
+            logger.debug("In splitIntoPages %s", pathday)
             files = []
+            toScale = []
             for  i in os.listdir(pathday):
                 if os.path.splitext(i)[1] in config.Extensions:files.append(i)
             files.sort()
@@ -140,16 +143,12 @@ class ModelProcessSelected(object):
                 for j in range(len(files)):
                     i = 1 + (j) / config.NbrPerPage
                     filename = os.path.join(pathday, config.PagePrefix + str(i), files[j])
-                    self.refreshSignal.emit(globalCount, files[j])
-                    globalCount += 1
                     shutil.move(os.path.join(pathday, files[j]), filename)
-                    scaleImage(filename, filigrane)
+                    toScale.append(filename)
             else:
                 for j in files:
-                    self.refreshSignal.emit(globalCount, j)
-                    globalCount += 1
-                    scaleImage(os.path.join(pathday, j), filigrane)
-            return globalCount
+                    toScale.append(os.path.join(pathday, j))
+            return toScale
 
         def arrangeOneFile(dirname, filename):
             """
@@ -172,10 +171,6 @@ class ModelProcessSelected(object):
 
         logger.debug("In Process Selected" + " ".join(lstFiles))
         self.startSignal.emit(self.__label, max(1, len(lstFiles)))
-        if config.Filigrane:
-            filigrane = Signature(config.FiligraneSource)
-        else:
-            filigrane = None
 
         SelectedDir = os.path.join(config.DefaultRepository, config.SelectedDirectory)
         self.refreshSignal.emit(-1, "copie des fichiers existants")
@@ -191,7 +186,7 @@ class ModelProcessSelected(object):
                 AlsoProcess += 1
 #end SingleDir normalization
             elif os.path.isdir(DayOrFile):
-                if day in [config.ScaledImages["Suffix"], config.Thumbnails["Suffix"]]:
+                if day in [rendition["Suffix"] for rendition in config.getRenditions()]:
                     fileutils.recursive_delete(DayOrFile)
                 elif day.find(config.PagePrefix) == 0: #subpages in SIngleDir mode that need to be flatten
                     for File in os.listdir(DayOrFile):
@@ -211,7 +206,7 @@ class ModelProcessSelected(object):
                                     if os.path.isfile(src) and not os.path.exists(dst):
                                         shutil.move(src, dst)
                                         AlsoProcess += 1
-                                    if (os.path.isdir(src)) and (os.path.split(src)[1] in [config.ScaledImages["Suffix"], config.Thumbnails["Suffix"]]):
+                                    if (os.path.isdir(src)) and (os.path.split(src)[1] in [rendition["Suffix"] for rendition in config.getRenditions()]):
                                         shutil.rmtree(src)
                         else:
                             if os.path.splitext(File)[1] in config.Extensions:
@@ -271,13 +266,13 @@ class ModelProcessSelected(object):
                     dst = os.path.join(SelectedDir, time.strftime("%Y-%m-%d_%Hh%Mm%S", timetuple) + suffix)
                     shutil.move(src, dst)
                 fileutils.recursive_delete(daydir)
-            splitIntoPages(SelectedDir, 0)
+            toScale = splitIntoPages(SelectedDir)
         else: #Multidir
             logger.debug("in Multidir, dirs= " + " ".join(dirs))
-            globalCount = 0
+            toScale = []
             for day in dirs:
-                globalCount = splitIntoPages(os.path.join(SelectedDir, day), globalCount)
-
+                toScale += splitIntoPages(os.path.join(SelectedDir, day))
+        runJobs(scaleImageJob, toScale, self.refreshSignal.emit)
         self.finishSignal.emit()
 
 
@@ -301,10 +296,6 @@ class ModelCopySelected(object):
         @param lstFiles: list of files to process
         """
         self.startSignal.emit(self.__label, max(1, len(lstFiles)))
-        if config.Filigrane:
-            filigrane = Signature(config.FiligraneSource)
-        else:
-            filigrane = None
 
         SelectedDir = os.path.join(config.DefaultRepository, config.SelectedDirectory)
         self.refreshSignal.emit(-1, "copie des fichiers existants")
@@ -319,31 +310,18 @@ class ModelCopySelected(object):
                             dst = os.path.join(SelectedDir, day, strImageFile)
                             if os.path.isfile(src) and not os.path.exists(dst):
                                 shutil.move(src, dst)
-                            if (os.path.isdir(src)) and (os.path.split(src)[1] in [config.ScaledImages["Suffix"], config.Thumbnails["Suffix"]]):
+                            if (os.path.isdir(src)) and (os.path.split(src)[1] in [rendition["Suffix"] for rendition in config.getRenditions()]):
                                 shutil.rmtree(src)
 
 #######then copy the selected files to their folders###########################        
-        globalCount = 0
+        toCopy = []
         for File in lstFiles:
             dest = os.path.join(SelectedDir, File)
-            src = os.path.join(config.DefaultRepository, File)
             destdir = os.path.dirname(dest)
-            self.refreshSignal.emit(globalCount, File)
-            globalCount += 1
             if not os.path.isdir(destdir):
                 fileutils.makedir(destdir)
-            if not os.path.exists(dest):
-                if filigrane:
-                    image = Image.open(src)
-                    filigrane.substract(image).save(dest, quality=config.FiligraneQuality, optimize=config.FiligraneOptimize, progressive=config.FiligraneOptimize)
-                else:
-                    shutil.copy(src, dest)
-                try:
-                    os.chmod(dest, config.DefaultFileMode)
-                except OSError:
-                    logger.warning("In ModelCopySelected: unable to chmod %s", dest)
-            else :
-                logger.info("In ModelCopySelected: %s already exists", dest)
+            toCopy.append((os.path.join(config.DefaultRepository, File), dest, File))
+        runJobs(copyImageJob, toCopy, self.refreshSignal.emit)
 ######copy the comments of the directory to the Selected directory 
         AlreadyDone = []
         for File in lstFiles:
@@ -384,7 +362,10 @@ class ModelRangeTout(object):
         @rtype: (list,integer)
         """
         config.DefaultRepository = rootDir
-        AllJpegs = fileutils.findFiles(rootDir)
+        if config.IncrementalScan:
+            AllJpegs = fileutils.scanFiles(rootDir)
+        else:
+            AllJpegs = fileutils.findFiles(rootDir)
         AllFilesToProcess = []
         AllreadyDone = []
         NewFiles = []
@@ -405,21 +386,21 @@ class ModelRangeTout(object):
                 AllFilesToProcess.append(i)
         AllFilesToProcess.sort()
         NumFiles = len(AllFilesToProcess)
-        self.startSignal.emit(self.__label, NumFiles)
+        self.startSignal.emit(self.__label, 3 * NumFiles)
+        #First stage, in parallel: read the Exif and compute the new name of each file
+        dictNames = {}
+        def collectName(idx, result):
+            dictNames[result[0]] = result[1:]
+            self.refreshSignal.emit(idx, result[0])
+        runJobs(importNameJob, AllFilesToProcess, collectName, initializer=None)
+        #Second stage, serialized in the original order: resolve name collisions and move files
+        dictOriginalNames = {} #original names of the files moved during this run, not yet written in their Exif
+        lstToFinalize = []
+        lstToRotate = []
         for h in range(NumFiles):
             i = AllFilesToProcess[h]
-            self.refreshSignal.emit(h, i)
-            myPhoto = Photo(i, dontCache=True)
-            data = myPhoto.readExif()
-            try:
-                datei, heurei = data["Heure"].split()
-                date = re.sub(":", "-", datei)
-                heurej = re.sub(":", "h", heurei, 1)
-                model = data["Modele"].split(",")[-1]
-                heure = unicode2ascii("%s-%s.jpg" % (re.sub(":", "m", heurej, 1), re.sub("/", "", re.sub(" ", "_", model))))
-            except ValueError:
-                date = time.strftime("%Y-%m-%d", time.gmtime(os.path.getctime(os.path.join(rootDir, i))))
-                heure = unicode2ascii("%s-%s.jpg" % (time.strftime("%Hh%Mm%S", time.gmtime(os.path.getctime(os.path.join(rootDir, i)))), re.sub("/", "-", re.sub(" ", "_", os.path.splitext(i)[0]))))
+            self.refreshSignal.emit(NumFiles + h, i)
+            date, heure, orientation = dictNames[i]
             if not (os.path.isdir(os.path.join(rootDir, date))) :
                 fileutils.mkdir(os.path.join(rootDir, date))
 #            strImageFile = os.path.join(rootDir, date, heure)
@@ -427,19 +408,22 @@ class ModelRangeTout(object):
             bSkipFile = False
             for strImageFile in fileutils.list_files_in_named_dir(rootDir, date, heure):
                 logger.warning("%s -x-> %s", i, strImageFile)
-                existing = Photo(strImageFile, dontCache=True)
-                try:
-                    existing.readExif()
-                    originalName = existing.exif["Exif.Photo.UserComment"]
-                except:
-                    logger.error("in ModelRangeTout: reading Exif for %s", i)
+                if strImageFile in dictOriginalNames:
+                    originalName = dictOriginalNames[strImageFile]
                 else:
+                    existing = Photo(strImageFile, dontCache=True)
+                    try:
+                        existing.readExif()
+                        originalName = existing.exif["Exif.Photo.UserComment"]
+                    except:
+                        logger.error("in ModelRangeTout: reading Exif for %s", i)
+                        continue
                     if "human_value" in dir(originalName):
                         originalName = originalName.human_value
-                    if os.path.basename(originalName) == os.path.basename(i):
-                        logger.info("File already in repository, leaving as it is")
-                        bSkipFile = True
-                        continue #to next file, i.e. leave the existing one
+                if os.path.basename(originalName) == os.path.basename(i):
+                    logger.info("File already in repository, leaving as it is")
+                    bSkipFile = True
+                    continue #to next file, i.e. leave the existing one
             if bSkipFile:
                 continue
             else:
@@ -456,14 +440,22 @@ class ModelRangeTout(object):
                 os.chmod(strImageFile, config.DefaultFileMode)
             except OSError:
                 logger.warning("in ModelRangeTout: unable to chown ot chmod  %s" , strImageFile)
-            myPhoto = Photo(strImageFile, dontCache=True)
-#            Save the old image name in exif tag
-            myPhoto.storeOriginalName(i)
-
-            if config.AutoRotate:
-                myPhoto.autorotate()
+            dictOriginalNames[strImageFile] = i
+            lstToFinalize.append((strImageFile, i))
+            if config.AutoRotate and (orientation != 1):
+                lstToRotate.append((0, strImageFile))
             AllreadyDone.append(ToProcess)
             NewFiles.append(ToProcess)
+        #Third stage, in parallel: save the old image name in exif tag ...
+        runJobs(importFinalizeJob, lstToFinalize,
+                lambda idx, filename: self.refreshSignal.emit(2 * NumFiles + idx, filename),
+                initializer=None)
+        # ... then rotate all images at once
+        if lstToRotate:
+            Exiftran.batch(lstToRotate)
+        #the new files are indexed under their final name, once modified, from this process only
+        for ToProcess in NewFiles:
+            Photo(ToProcess, dontCache=True).readExif()
         AllreadyDone.sort()
         self.finishSignal.emit()
 
@@ -673,32 +665,172 @@ def copySelected(lstSelectedFiles):
 #######################################################################################
 def scaleImage(filename, filigrane=None):
     """Common processing for one image : 
-    - create a subfolder "scaled" and "thumb"
+    - create a subfolder "scaled" and "thumb" (and one per extra rendition)
     - populate it
     
+    The image is decoded only once: all renditions are made in cascade 
+    from the largest to the smallest.
+    
     @param filename: path to the file
     @param filigrane: None or a Signature instance (see imagizer.photo.Signature) 
      """
     rootdir = os.path.dirname(filename)
-    scaledir = os.path.join(rootdir, config.ScaledImages["Suffix"])
-    thumbdir = os.path.join(rootdir, config.Thumbnails["Suffix"])
-    fileutils.mkdir(scaledir)
-    fileutils.mkdir(thumbdir)
     photo = Photo(filename, dontCache=True)
-    param = config.ScaledImages.copy()
-    param.pop("Suffix")
-    param["strThumbFile"] = os.path.join(scaledir, os.path.basename(filename))[:-4] + "--%s.jpg" % config.ScaledImages["Suffix"]
-    photo.saveThumb(**param)
-    param = config.Thumbnails.copy()
-    param.pop("Suffix")
-    param["strThumbFile"] = os.path.join(thumbdir, os.path.basename(filename))[:-4] + "--%s.jpg" % config.Thumbnails["Suffix"]
-    photo.saveThumb(**param)
+    lstParam = []
+    for rendition in config.getRenditions():
+        subdir = os.path.join(rootdir, rendition["Suffix"])
+        fileutils.mkdir(subdir)
+        param = rendition.copy()
+        param.pop("Suffix")
+        param["strThumbFile"] = os.path.join(subdir, os.path.basename(filename))[:-4] + "--%s.jpg" % rendition["Suffix"]
+        lstParam.append(param)
     if filigrane is not None:
-        filigrane.substract(photo.pil).save(filename, quality=config.FiligraneQuality, optimize=config.FiligraneOptimize, progressive=config.FiligraneOptimize)
+        #the full image is needed for the watermark: decode it once for everything
+        photo.saveRenditions(lstParam, source=photo.pil)
+        filigrane.substract(photo.pil, inplace=True).save(filename, quality=config.FiligraneQuality, optimize=config.FiligraneOptimize, progressive=config.FiligraneOptimize)
         try:
             os.chmod(filename, config.DefaultFileMode)
         except OSError:
             logger.warning("in scaleImage: Unable to chmod %s" % filename)
+    else:
+        photo.saveRenditions(lstParam)
+
+
+def copyImage(src, dest, filigrane=None):
+    """Common processing for one image exported by copySelected:
+    copy it to the selected directory, with a signature if requested
+    
+    @param src: path of the original image
+    @param dest: path of the copy 
+    @param filigrane: None or a Signature instance (see imagizer.photo.Signature) 
+    """
+    if not os.path.exists(dest):
+        if filigrane:
+            image = Image.open(src)
+            filigrane.substract(image, inplace=True).save(dest, quality=config.FiligraneQuality, optimize=config.FiligraneOptimize, progressive=config.FiligraneOptimize)
+        else:
+            shutil.copy(src, dest)
+        try:
+            os.chmod(dest, config.DefaultFileMode)
+        except OSError:
+            logger.warning("In copyImage: unable to chmod %s", dest)
+    else :
+        logger.info("In copyImage: %s already exists", dest)
+
+
+#######################################################################################
+# Parallel execution of the per-image jobs of processSelected and copySelected
+#######################################################################################
+workerFiligrane = None
+
+def initWorker():
+    """
+    Initialization of a worker process: 
+    each worker builds its own signature as PIL images cannot be sent to other processes
+    """
+    global workerFiligrane
+    if config.Filigrane:
+        workerFiligrane = Signature(config.FiligraneSource)
+    else:
+        workerFiligrane = None
+
+
+def scaleImageJob(filename):
+    """
+    Job executed in a worker process for processSelected
+    @param filename: path to the file
+    @return: the name of the file processed (for the progress-bar)
+    """
+    scaleImage(filename, workerFiligrane)
+    return os.path.basename(filename)
+
+
+def copyImageJob(args):
+    """
+    Job executed in a worker process for copySelected
+    @param args: 3-tuple with the source, the destination and the name of the file
+    @return: the name of the file processed (for the progress-bar)
+    """
+    src, dest, File = args
+    copyImage(src, dest, workerFiligrane)
+    return File
+
+
+def importNameJob(filename):
+    """
+    Job executed in a worker process for rangeTout: read the Exif of a new file 
+    and calculate its name in the repository
+    @param filename: path to the file, from the repository root
+    @return: 4-tuple with the file, the day directory, the new name in this directory 
+            and the Exif orientation
+    """
+    rootDir = config.DefaultRepository
+    myPhoto = Photo(filename, dontCache=True)
+    #the file is about to be moved: it is indexed under its final name by rangeTout
+    data = myPhoto.readExif(index=False)
+    try:
+        datei, heurei = data["Heure"].split()
+        date = re.sub(":", "-", datei)
+        heurej = re.sub(":", "h", heurei, 1)
+        model = data["Modele"].split(",")[-1]
+        heure = unicode2ascii("%s-%s.jpg" % (re.sub(":", "m", heurej, 1), re.sub("/", "", re.sub(" ", "_", model))))
+    except ValueError:
+        date = time.strftime("%Y-%m-%d", time.gmtime(os.path.getctime(os.path.join(rootDir, filename))))
+        heure = unicode2ascii("%s-%s.jpg" % (time.strftime("%Hh%Mm%S", time.gmtime(os.path.getctime(os.path.join(rootDir, filename)))), re.sub("/", "-", re.sub(" ", "_", os.path.splitext(filename)[0]))))
+    return filename, date, heure, myPhoto.orientation
+
+
+def importFinalizeJob(args):
+    """
+    Job executed in a worker process for rangeTout: store the original name
+    of a file just moved into the repository.
+    @param args: 2-tuple with the path of the image and its original name
+    @return: the original name of the file (for the progress-bar)
+    """
+    strImageFile, originalName = args
+    photo = Photo(strImageFile, dontCache=True)
+    photo.storeOriginalName(originalName)
+    #worker processes do not run the exit handlers: write it now
+    photo.flushMetadata()
+    return originalName
+
+
+def runJobs(job, lstArgs, refresh, initializer=initWorker):
+    """
+    Execute a job on every element of a list, in a pool of config.NbrWorkers processes
+    (one per processor if 0, in the current process if 1). 
+    
+    @param job: function to execute, it must be defined at module level 
+    @param lstArgs: list of arguments, one per job
+    @param refresh: called in the current process after each job with the number of 
+                    jobs finished and the result of the job, i.e. model.refreshSignal.emit
+    @param initializer: function called once in each worker process before the jobs
+    """
+    nbWorkers = config.NbrWorkers
+    if nbWorkers <= 0:
+        nbWorkers = multiprocessing.cpu_count()
+    nbWorkers = min(nbWorkers, len(lstArgs))
+    if nbWorkers <= 1:
+        if initializer is not None:
+            initializer()
+        for idx, args in enumerate(lstArgs):
+            refresh(idx, job(args))
+    else:
+        logger.info("Processing %i images with %i processes", len(lstArgs), nbWorkers)
+        #no background thread may hold a lock (ImageCache, MetadataIndex, MetadataWriter)
+        #while the worker processes are forked: they would inherit it locked forever
+        Prefetcher.pauseAll()
+        MetadataWriter().flush()
+        try:
+            pool = multiprocessing.Pool(nbWorkers, initializer=initializer)
+        finally:
+            Prefetcher.resumeAll()
+        try:
+            for idx, result in enumerate(pool.imap_unordered(job, lstArgs)):
+                refresh(idx, result)
+        finally:
+            pool.close()
+            pool.join()
 
 
 def timer_pass():
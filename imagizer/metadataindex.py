@@ -0,0 +1,323 @@
+#!/usr/bin/env python 
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#* $Source$
+#* $Id$
+#*
+#* Copyright (C) 2006-2011,  Jérome Kieffer <kieffer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#* This program is free software; you can redistribute it and/or modify
+#* it under the terms of the GNU General Public License as published by
+#* the Free Software Foundation; either version 2 of the License, or
+#* (at your option) any later version.
+#*
+#* This program is distributed in the hope that it will be useful,
+#* but WITHOUT ANY WARRANTY; without even the implied warranty of
+#* MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#* GNU General Public License for more details.
+#*
+#* You should have received a copy of the GNU General Public License
+#* along with this program; if not, write to the Free Software
+#* Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#*
+#*****************************************************************************/
+
+
+"""
+MetadataIndex is a persistent index (SQLite database at the root of the repository)
+of the metadata of all images: file modification time and size, dimensions, 
+orientation, title, rating and the other fields returned by Photo.readExif.
+
+It is updated incrementally each time an image is read and allows to navigate 
+(next titled image, rating filter, ...) without opening the JPEG files.
+It also remembers the content of each directory with its modification time, 
+so that the repository can be scanned incrementally (see fileutils.scanFiles).
+Technically it is a Borg (design Pattern) so every instance shares the same database connection.
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import os, logging, threading, json, sqlite3, atexit
+import os.path as op
+logger = logging.getLogger("imagizer.metadataindex")
+from config import Config
+config = Config()
+
+
+class MetadataIndex(object):
+    """
+    this class is a Borg : always returns the same values regardless to the instance of the object.
+    All methods are no-op when the index is disabled (empty config.MetadataIndexFile).
+    """
+    __shared_state = {}
+    __data_initialized = False
+    #Time to wait for a lock held by another process (i.e. import workers), in seconds
+    timeout = 1.0
+
+    def __init__(self):
+        """
+        Constructor of MetadataIndex: the database is opened on first use
+        """
+        self.__dict__ = self.__shared_state
+        if  MetadataIndex.__data_initialized is False:
+            MetadataIndex.__data_initialized = True
+            logger.debug("MetadataIndex.__init__: initalization of the Borg")
+            self.lock = threading.RLock()
+            self.connection = None
+            self.filename = None
+            self.pid = None
+            atexit.register(self.close)
+
+
+    def getConnection(self):
+        """
+        @return: the connection to the database of the current repository or None if disabled 
+        """
+        if not config.MetadataIndexFile:
+            return None
+        filename = op.join(config.DefaultRepository, config.MetadataIndexFile)
+        if (self.pid is not None) and (self.pid != os.getpid()):
+            #forked process: the lock may be held by a thread of the parent and
+            #the connection must not be shared
+            self.lock = threading.RLock()
+            self.connection = None
+        with self.lock:
+            if (self.connection is None) or (filename != self.filename) or (self.pid != os.getpid()):
+                if (self.connection is not None) and (self.pid == os.getpid()):
+                    self.close()
+                logger.debug("MetadataIndex: opening %s" % filename)
+                try:
+                    self.connection = sqlite3.connect(filename, timeout=self.timeout, check_same_thread=False)
+                    #file names and titles are UTF-8 byte strings, like os.listdir and the JPEG comment
+                    self.connection.text_factory = str
+                    #readers do not block the writer and each commit is cheap, yet crash-safe
+                    self.connection.execute("PRAGMA journal_mode=WAL")
+                    self.connection.execute("PRAGMA synchronous=NORMAL")
+                    self.connection.execute("CREATE TABLE IF NOT EXISTS images ("
+                                            "filename TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+                                            "width INTEGER, height INTEGER, orientation INTEGER, "
+                                            "title TEXT, rate INTEGER, metadata TEXT)")
+                    self.connection.execute("CREATE TABLE IF NOT EXISTS directories ("
+                                            "dirname TEXT PRIMARY KEY, mtime REAL, files TEXT, subdirs TEXT)")
+                except sqlite3.Error as error:
+                    logger.warning("MetadataIndex: unable to open %s: %s" % (filename, error))
+                    self.connection = None
+                self.filename = filename
+                self.pid = os.getpid()
+            return self.connection
+
+
+    def commit(self):
+        """
+        Flush pending modifications to disk (each write is already committed)
+        """
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.connection.commit()
+                except sqlite3.Error as error:
+                    logger.warning("MetadataIndex: unable to commit: %s" % error)
+                    self.connection.rollback()
+
+
+    def close(self):
+        """
+        Commit and close the database
+        """
+        with self.lock:
+            if self.connection is not None:
+                self.commit()
+                self.connection.close()
+                self.connection = None
+
+
+    def write(self, connection, *queries):
+        """
+        Execute modifications of the database in one transaction, committed at once 
+        so that other processes are never locked out for long: the index is only 
+        a cache so a failure (i.e. database locked by another process) is not fatal.
+        
+        @param connection: connection to the database
+        @param queries: 2-tuples (SQL statement, values)
+        """
+        with self.lock:
+            try:
+                for sql, values in queries:
+                    connection.execute(sql, values)
+                connection.commit()
+            except sqlite3.Error as error:
+                logger.warning("MetadataIndex: unable to update the index: %s" % error)
+                connection.rollback()
+
+
+    def get(self, filename, check=True):
+        """
+        Retrieve the metadata of an image
+        
+        @param filename: name of the image, starting from the repository root
+        @param check: validate the entry against the modification time and size of the file
+        @return: dictionary with "metadata" (as from Photo.readExif), "width", "height", 
+                 "orientation", "title" and "rate", or None if not indexed or outdated
+        """
+        connection = self.getConnection()
+        if connection is None:
+            return None
+        with self.lock:
+            row = connection.execute("SELECT mtime, size, width, height, orientation, title, rate, metadata FROM images WHERE filename=?",
+                                     (filename,)).fetchone()
+        if row is None:
+            return None
+        if check:
+            try:
+                stat = os.stat(op.join(config.DefaultRepository, filename))
+            except OSError:
+                self.remove(filename)
+                return None
+            if (stat.st_mtime != row[0]) or (stat.st_size != row[1]):
+                logger.debug("MetadataIndex: %s is outdated" % filename)
+                return None
+        metadata = json.loads(row[7])
+        #json gives back unicode: the title is a byte string, as read from the JPEG comment
+        if isinstance(metadata.get("Titre"), unicode):
+            metadata["Titre"] = metadata["Titre"].encode("UTF-8")
+        return {"width": row[2], "height": row[3], "orientation": row[4],
+                "title": row[5], "rate": row[6], "metadata": metadata}
+
+
+    def put(self, filename, metadata, width=None, height=None, orientation=1):
+        """
+        Store the metadata of an image
+        
+        @param filename: name of the image, starting from the repository root
+        @param metadata: dictionary as returned by Photo.readExif
+        @param width, height: dimensions of the image in pixels
+        @param orientation: Exif orientation
+        """
+        connection = self.getConnection()
+        if connection is None:
+            return
+        try:
+            stat = os.stat(op.join(config.DefaultRepository, filename))
+        except OSError:
+            logger.warning("MetadataIndex: no such file %s" % filename)
+            return
+        try:
+            rate = int(float(metadata.get("Rate", 0)))
+        except (ValueError, TypeError):
+            rate = 0
+        try:
+            values = (filename, stat.st_mtime, stat.st_size, width, height, orientation,
+                      metadata.get("Titre", u""), rate, json.dumps(metadata))
+        except (TypeError, ValueError) as error:
+            logger.warning("MetadataIndex: unable to index %s: %s" % (filename, error))
+            return
+        self.write(connection, ("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", values))
+
+
+    def remove(self, filename):
+        """
+        Remove an image from the index
+        @param filename: name of the image, starting from the repository root
+        """
+        connection = self.getConnection()
+        if connection is None:
+            return
+        self.write(connection, ("DELETE FROM images WHERE filename=?", (filename,)))
+
+
+    def rename(self, oldname, newname):
+        """
+        Change the name of an image in the index
+        """
+        connection = self.getConnection()
+        if connection is None:
+            return
+        self.write(connection, ("DELETE FROM images WHERE filename=?", (newname,)),
+                   ("UPDATE images SET filename=? WHERE filename=?", (newname, oldname)))
+
+
+    def getDirectory(self, dirname):
+        """
+        Retrieve the content of a directory as it was at the last scan
+        
+        @param dirname: name of the directory, starting from the repository root 
+        @return: 3-tuple (mtime, list of files, list of sub-directories) or None if never scanned
+        """
+        connection = self.getConnection()
+        if connection is None:
+            return None
+        with self.lock:
+            row = connection.execute("SELECT mtime, files, subdirs FROM directories WHERE dirname=?", (dirname,)).fetchone()
+        if row is None:
+            return None
+        #names are stored as UTF-8 by json: give back byte strings like os.listdir
+        files = [i.encode("UTF-8") for i in json.loads(row[1])]
+        subdirs = [i.encode("UTF-8") for i in json.loads(row[2])]
+        return row[0], files, subdirs
+
+
+    def putDirectory(self, dirname, mtime, files, subdirs):
+        """
+        Store the content of a directory
+        
+        @param dirname: name of the directory, starting from the repository root
+        @param mtime: modification time of the directory when it was listed
+        @param files: list of the names of the files in the directory
+        @param subdirs: list of the names of the sub-directories to descend into
+        """
+        connection = self.getConnection()
+        if connection is None:
+            return
+        try:
+            values = (dirname, mtime, json.dumps(files), json.dumps(subdirs))
+        except (TypeError, ValueError) as error:
+            logger.warning("MetadataIndex: unable to index directory %s: %s" % (dirname, error))
+            return
+        self.write(connection, ("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)", values))
+
+
+    def find(self, lstFiles, start, stop, step, predicate):
+        """
+        Search for the first image of the list matching the predicate, 
+        using the index and reading only images not indexed. 
+        Only the image found is checked against its modification time.
+        
+        @param lstFiles: list of images, i.e. AllJpegs
+        @param start, stop, step: range of indexes to scan, as for xrange
+        @param predicate: function taking a dictionary with "Titre" and "Rate" and returning a boolean
+        @return: index in lstFiles of the first image matching or None
+        """
+        from photo import Photo
+        indexes = xrange(start, stop, step)
+        if not indexes:
+            return None
+        rows = {}
+        connection = self.getConnection()
+        if connection is not None:
+            names = [lstFiles[idx] for idx in indexes]
+            with self.lock:
+                cursor = connection.execute("SELECT filename, mtime, title, rate FROM images WHERE filename BETWEEN ? AND ?",
+                                            (min(names), max(names)))
+                for filename, mtime, title, rate in cursor:
+                    rows[filename] = (mtime, {"Titre": title, "Rate": rate})
+        for idx in indexes:
+            filename = lstFiles[idx]
+            row = rows.get(filename)
+            if row is not None:
+                if not predicate(row[1]):
+                    continue
+                try:
+                    mtime = os.stat(op.join(config.DefaultRepository, filename)).st_mtime
+                except OSError:
+                    self.remove(filename)
+                    continue
+                if mtime == row[0]:
+                    return idx
+            #not indexed or modified outside selector: (re-)read the image, which updates the index
+            if predicate(Photo(filename, dontCache=True).readExif()):
+                return idx
+        return None
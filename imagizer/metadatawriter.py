@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#* $Source$
+#* $Id$
+#*
+#* Copyright (C) 2006 - 2012,  Jérôme Kieffer <imagizer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#* This program is free software; you can redistribute it and/or modify
+#* it under the terms of the GNU General Public License as published by
+#* the Free Software Foundation; either version 2 of the License, or
+#* (at your option) any later version.
+#*
+#* This program is distributed in the hope that it will be useful,
+#* but WITHOUT ANY WARRANTY; without even the implied warranty of
+#* MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#* GNU General Public License for more details.
+#*
+#* You should have received a copy of the GNU General Public License
+#* along with this program; if not, write to the Free Software
+#* Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#*
+#*****************************************************************************/
+
+"""
+MetadataWriter writes the metadata of the images (JPEG comment, EXIF tags)
+in a background thread, so that entitling or rating images does not wait
+for the disk.
+
+Successive modifications of the same file are merged and written at once,
+after a short delay. Each file is written as a temporary copy which then
+replaces the original (atomic rename), so an interrupted write never leaves
+a truncated image. Pending writes are flushed at exit, or on demand before
+any other modification of the file (rotation, renaming, ...).
+Technically it is a Borg (design Pattern) so every instance shares the same queue.
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import os, logging, threading, shutil, tempfile, atexit, time
+import os.path as op
+from collections import OrderedDict
+logger = logging.getLogger("imagizer.metadatawriter")
+from exif import Exif
+
+
+class MetadataWriter(object):
+    """
+    this class is a Borg : always returns the same values regardless to the instance of the object
+    """
+    __shared_state = {}
+    __data_initialized = False
+    #Time to wait for other modifications of the same file before writing, in seconds
+    delay = 0.5
+
+    def __init__(self):
+        """
+        Constructor of MetadataWriter: the thread is started on first use
+        """
+        self.__dict__ = self.__shared_state
+        if  MetadataWriter.__data_initialized is False:
+            MetadataWriter.__data_initialized = True
+            logger.debug("MetadataWriter.__init__: initalization of the Borg")
+            self.pending = OrderedDict()
+            self.condition = threading.Condition()
+            self.writing = threading.Lock()
+            self.thread = None
+            self.pid = os.getpid()
+            atexit.register(self.flush)
+
+
+    def checkProcess(self):
+        """
+        In a process forked while the thread was running, the locks may be held
+        by a thread which does not exist any more: start again from scratch.
+        The pending modifications belong to the parent process, which writes them. 
+        """
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = OrderedDict()
+            self.condition = threading.Condition()
+            self.writing = threading.Lock()
+            self.thread = None
+
+
+    def put(self, filename, comment=None, exif=None, callback=None):
+        """
+        Queue modifications of the metadata of a file
+
+        @param filename: path of the image
+        @param comment: new JPEG comment or None to keep it
+        @param exif: dictionary of EXIF tags to set, i.e. {"Exif.Image.Rating": 3}
+        @param callback: function without argument called once the file is written
+        """
+        self.checkProcess()
+        with self.condition:
+            if filename in self.pending:
+                edits = self.pending.pop(filename)
+            else:
+                edits = {"comment": None, "exif": {}, "callbacks": []}
+            edits["time"] = time.time()
+            if comment is not None:
+                edits["comment"] = comment
+            if exif:
+                edits["exif"].update(exif)
+            if callback is not None:
+                edits["callbacks"].append(callback)
+            self.pending[filename] = edits
+            if (self.thread is None) or not self.thread.isAlive():
+                self.thread = threading.Thread(target=self.run, name="MetadataWriter")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify()
+
+
+    def run(self):
+        """
+        Main loop of the background thread
+        """
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                #files are ordered by last modification
+                filename, edits = self.pending.iteritems().next()
+                wait = edits["time"] + self.delay - time.time()
+            if wait > 0:
+                #let the user continue modifying the same file
+                time.sleep(wait)
+                continue
+            with self.writing:
+                with self.condition:
+                    edits = self.pending.pop(filename, None)
+                if edits is not None:
+                    self.write(filename, edits)
+
+
+    def flush(self, filename=None):
+        """
+        Write the pending modifications now, in the calling thread
+
+        @param filename: only write this file, by default all files
+        """
+        self.checkProcess()
+        with self.writing:
+            while True:
+                with self.condition:
+                    if filename is None:
+                        if not self.pending:
+                            return
+                        name, edits = self.pending.popitem(last=False)
+                    elif filename in self.pending:
+                        name, edits = filename, self.pending.pop(filename)
+                    else:
+                        return
+                self.write(name, edits)
+
+
+    def write(self, filename, edits):
+        """
+        Write the metadata into a copy of the file which then replaces it
+
+        @param filename: path of the image
+        @param edits: dictionary with "comment", "exif" and "callbacks"
+        """
+        logger.debug("MetadataWriter.write %s: %s" % (filename, edits["exif"].keys()))
+        fd, tmpfile = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=op.dirname(filename))
+        os.close(fd)
+        try:
+            shutil.copy2(filename, tmpfile)
+            metadata = Exif(tmpfile)
+            metadata.read()
+            for key, value in edits["exif"].items():
+                metadata[key] = value
+            if edits["comment"] is not None:
+                metadata.comment = edits["comment"]
+            metadata.write()
+            if os.name == 'nt':
+                os.remove(filename)
+            os.rename(tmpfile, filename)
+        except Exception as error:
+            #i.e. IOError, or any error of pyexiv2 on a bad value or a corrupted file:
+            #only the edits of this file are lost, the thread goes on with the others
+            logger.error("Unable to write the metadata of %s: %s: %s" % (filename, error.__class__.__name__, error))
+            if op.exists(tmpfile):
+                os.remove(tmpfile)
+            return
+        for callback in edits["callbacks"]:
+            try:
+                callback()
+            except Exception as error:
+                logger.error("Error in the callback after writing %s: %s: %s" % (filename, error.__class__.__name__, error))
@@ -32,7 +32,8 @@ __contact__ = "imagizer@terre-adelie.org"
 __date__ = "20120530"
 __license__ = "GPL"
 
-import os, logging, shutil, time, subprocess
+import os, logging, shutil, time, subprocess, StringIO, threading, multiprocessing
+from collections import OrderedDict
 import os.path as op
 installdir = op.dirname(__file__)
 logger = logging.getLogger("imagizer.photo")
@@ -59,7 +60,7 @@ from config import Config
 config = Config()
 if config.ImageCache > 1:
     import imagecache
-    imageCache = imagecache.ImageCache(maxSize=config.ImageCache)
+    imageCache = imagecache.ImageCache(maxSize=config.ImageCache, maxMemory=int(config.ImageCacheMemory * 2 ** 20))
 else:
     imageCache = None
 
@@ -67,7 +68,95 @@ from exif       import Exif
 from exiftran   import Exiftran
 from fileutils  import mkdir, makedir, smartSize
 from encoding   import unicode2ascii
-import blur
+from metadataindex import MetadataIndex
+from metadatawriter import MetadataWriter
+import blur, exifreader
+metadataIndex = MetadataIndex()
+metadataWriter = MetadataWriter()
+
+
+def pil2pixbuf(img):
+    """
+    Convert a PIL image into a gtk pixbuf 
+    
+    @param img: PIL image in RGB mode
+    @return: gtk.gdk.Pixbuf 
+    """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    width, height = img.size
+    return gtk.gdk.pixbuf_new_from_data(img.tostring(), gtk.gdk.COLORSPACE_RGB, False, 8, width, height, 3 * width)
+
+
+def contrastMaskTiles(img_array, sigma, gaussian, tileSize=512, nbThreads=1):
+    """
+    Contrast mask filter on a RGB image, computed tile per tile so that the 
+    memory needed does not depend on the size of the image. 
+    Each tile is blurred with an overlap of 4 sigma taken from its neighbours,
+    then the screen, multiply and add steps of the filter are done in one go 
+    with the integer arithmetic of ImageChops.
+    
+    @param img_array: RGB image as an uint8 array of shape (height, width, 3)
+    @param sigma: standard deviation of the gaussian blur of the mask
+    @param gaussian: blur.Gaussian instance used for the blur
+    @param tileSize: size of the tiles, without the overlap
+    @param nbThreads: number of threads processing the tiles
+    @return: filtered image as an uint8 array of the same shape
+    """
+    import numpy
+    dimY, dimX = img_array.shape[:2]
+    k = int(numpy.ceil(float(sigma)))
+    margin = 4 * k
+    output = numpy.empty_like(img_array)
+
+    def region(start, stop, dim):
+        """Span of a tile with its overlap, with the same parity as the image 
+        so that the blur kernel is centered the same way"""
+        lo = max(0, start - margin)
+        hi = min(dim, stop + margin)
+        if (hi - lo - dim) % 2:
+            if lo > 0:
+                lo -= 1
+            else:
+                hi += 1
+        return lo, hi
+
+    def process(y0, y1, x0, x1):
+        ry0, ry1 = region(y0, y1, dimY)
+        rx0, rx1 = region(x0, x1, dimX)
+        tile = img_array[ry0:ry1, rx0:rx1]
+        desat = (numpy.minimum(numpy.minimum(tile[:, :, 0], tile[:, :, 1]), tile[:, :, 2]).astype("float32") + \
+                 numpy.maximum(numpy.maximum(tile[:, :, 0], tile[:, :, 1]), tile[:, :, 2])) / 2.0
+        blured = gaussian.blur(255.0 - desat, sigma)
+        mask = numpy.round(blured[y0 - ry0:y1 - ry0, x0 - rx0:x1 - rx0]).clip(0, 255).astype("uint16")[:, :, numpy.newaxis]
+        p = img_array[y0:y1, x0:x1].astype("uint16")
+        q = 255 - p
+        screen = 255 - q * (255 - mask) // 255
+        multiply = p * mask // 255
+        output[y0:y1, x0:x1] = numpy.minimum(p * screen // 255 + q * multiply // 255, 255)
+
+    lstTiles = [(y0, min(y0 + tileSize, dimY), x0, min(x0 + tileSize, dimX))
+                for y0 in range(0, dimY, tileSize) for x0 in range(0, dimX, tileSize)]
+    lstTiles.reverse()
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not lstTiles:
+                    return
+                tile = lstTiles.pop()
+            process(*tile)
+    nbThreads = max(1, min(nbThreads, len(lstTiles)))
+    if nbThreads == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for i in range(nbThreads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return output
+
 
 ##########################################################
 # # # # # # Début de la classe photo # # # # # # # # # # #
@@ -91,9 +180,11 @@ class Photo(object):
         self._exif = None
         self.scaledPixbuffer = None
         self.orientation = 1
-        if (imageCache is not None) and (filename in imageCache):
+        fromCache = None
+        if imageCache is not None:
+            fromCache = imageCache.get(filename)
+        if fromCache is not None:
             logger.debug("Image %s found in Cache", filename)
-            fromCache = imageCache[filename]
             self.metadata = fromCache.metadata
             self._pixelsX = fromCache.pixelsX
             self._pixelsY = fromCache.pixelsY
@@ -111,6 +202,7 @@ class Photo(object):
     def getPIL(self):
         if self._pil is None:
             self._pil = Image.open(self.fn)
+            self.updateCache()
         return self._pil
     def setPIL(self, value):self._pil = value
     def delPIL(self):
@@ -142,11 +234,32 @@ class Photo(object):
 
     def getExif(self):
         if self._exif is None:
+            metadataWriter.flush(self.fn)
             self._exif = Exif(self.fn)
             self._exif.read()
         return self._exif
     exif = property(getExif, doc="property for exif data")
 
+    def getReducedPIL(self, width, height):
+        """
+        Decode the image at reduced resolution: for JPEG images libjpeg is asked 
+        (via PIL's draft mode) to decode directly at 1/2, 1/4 or 1/8 of the size,
+        the largest reduction still larger than width x height.
+        The final resampling has to be done by the caller.
+        
+        @param width: minimum width needed  
+        @param height: minimum height needed
+        @return: a new PIL image, independent from self.pil
+        """
+        img = Image.open(self.fn)
+        img.draft("RGB", (int(width), int(height)))
+        img.load()
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        logger.debug("Reduced decoding of %s: %sx%s -> %sx%s" % (self.filename, self.pixelsX, self.pixelsY, img.size[0], img.size[1]))
+        return img
+
+
     def larg(self):
         """width-height of a jpeg file"""
         return self.pixelsX - self.pixelsY
@@ -160,7 +273,7 @@ class Photo(object):
         self.getPIL()
 
 
-    def saveThumb(self, strThumbFile, Size=160, Interpolation=1, Quality=75, Progressive=False, Optimize=False, ExifExtraction=False):
+    def saveThumb(self, strThumbFile, Size=160, Interpolation=1, Quality=75, Progressive=False, Optimize=False, ExifExtraction=False, Engine="PIL"):
         """save a thumbnail of the given name, with the given size and the interpolation methode (quality) 
         resampling filters :
         NONE = 0
@@ -168,33 +281,96 @@ class Photo(object):
         ANTIALIAS = 1 # 3-lobed lanczos
         LINEAR = BILINEAR = 2
         CUBIC = BICUBIC = 3
+        Engine is either "PIL" or "libexiftran" (C code, the interpolation is then ignored)
         """
-        if  op.isfile(strThumbFile):
-            logger.warning("Thumbnail %s exists" % strThumbFile)
-        else:
+        self.saveRenditions([{"strThumbFile": strThumbFile, "Size": Size, "Interpolation": Interpolation, "Quality": Quality,
+                              "Progressive": Progressive, "Optimize": Optimize, "ExifExtraction": ExifExtraction, "Engine": Engine}])
+
+
+    def extractThumb(self, strThumbFile):
+        """
+        Try to extract the thumbnail embedded in the Exif data
+         
+        @param strThumbFile: name of the thumbnail file to write 
+        @return: True if the thumbnail has been extracted with the right orientation
+        """
+        try:
+            self.exif.dumpThumbnailToFile(strThumbFile[:-4])
+            extract = True
+        except (OSError, IOError):
             extract = False
+        #Check if the thumbnail is correctly oriented
+        if op.isfile(strThumbFile):
+            thumbImag = Photo(strThumbFile)
+            if self.larg() * thumbImag.larg() < 0:
+                print("Warning: thumbnail was not with the same orientation as original: %s" % self.filename)
+                os.remove(strThumbFile)
+                extract = False
+        return extract
+
+
+    def saveRenditions(self, lstParam, source=None):
+        """
+        Save several downscaled images from a single decoding of the image:
+        renditions are made from the largest to the smallest, each one 
+        being downscaled from the previous one (cascade).
+        
+        @param lstParam: list of dictionaries with the parameters of saveThumb (strThumbFile, Size, Interpolation, ...)
+                        renditions with the "libexiftran" Engine are made separately by libexiftran.
+        @param source: PIL image already decoded at full size (optional), else the image is decoded 
+                       at reduced size, just large enough for the largest rendition.
+        """
+        todo = []
+        for param in sorted(lstParam, key=lambda param: param["Size"], reverse=True):
+            strThumbFile = param["strThumbFile"]
+            if  op.isfile(strThumbFile):
+                logger.warning("Thumbnail %s exists" % strThumbFile)
+                continue
             print "process file %s exists" % strThumbFile
-            if ExifExtraction:
-                try:
-                    self.exif.dumpThumbnailToFile(strThumbFile[:-4])
-                    extract = True
-                except (OSError, IOError):
-                    extract = False
-                #Check if the thumbnail is correctly oriented
-                if op.isfile(strThumbFile):
-                    thumbImag = Photo(strThumbFile)
-                    if self.larg() * thumbImag.larg() < 0:
-                        print("Warning: thumbnail was not with the same orientation as original: %s" % self.filename)
-                        os.remove(strThumbFile)
-                        extract = False
-            if not extract:
-                copyOfImage = self.pil.copy()
-                copyOfImage.thumbnail((Size, Size), Interpolation)
-                copyOfImage.save(strThumbFile, quality=Quality, progressive=Progressive, optimize=Optimize)
-            try:
-                os.chmod(strThumbFile, config.DefaultFileMode)
-            except OSError:
-                print("Warning: unable to chmod %s" % strThumbFile)
+            if param.get("ExifExtraction") and self.extractThumb(strThumbFile):
+                self.chmod(strThumbFile)
+            elif (source is None) and (param.get("Engine") == "libexiftran") and \
+                    Exiftran.thumbnail(self.fn, strThumbFile, param["Size"], param.get("Quality", 75), param.get("Progressive", False), param.get("Optimize", False)):
+                self.chmod(strThumbFile)
+            else:
+                todo.append(param)
+        if not todo:
+            return
+        if source is None:
+            ratio = min(1.0, float(todo[0]["Size"]) / max(self.pixelsX, self.pixelsY))
+            current = self.getReducedPIL(ratio * self.pixelsX, ratio * self.pixelsY)
+        else:
+            current = source
+        for param in todo:
+            Size = param["Size"]
+            ratio = float(Size) / max(current.size)
+            if ratio < 1:
+                #like PIL's thumbnail but without copying the source
+                size = (max(1, int(current.size[0] * ratio)), max(1, int(current.size[1] * ratio)))
+                current = current.resize(size, param.get("Interpolation", 1))
+            current.save(param["strThumbFile"], quality=param.get("Quality", 75), progressive=param.get("Progressive", False), optimize=param.get("Optimize", False))
+            self.chmod(param["strThumbFile"])
+
+
+    def chmod(self, strFile):
+        """set the default mode to a file derived from this image"""
+        try:
+            os.chmod(strFile, config.DefaultFileMode)
+        except OSError:
+            print("Warning: unable to chmod %s" % strFile)
+
+
+    def transform(self, action):
+        """
+        Lossless transformation of the JPEG file with exiftran: when done in memory,
+        the PIL image already loaded is re-opened from the new data without reading the file again.
+        
+        @param action: 0 for autorotate, 1 for 180 deg, 2 for 270 deg and 9 for 90 deg reotation clockwise 
+        """
+        metadataWriter.flush(self.fn)
+        data = Exiftran.transformFile(action, self.fn)
+        if (data is not None) and (self._pil is not None):
+            self._pil = Image.open(StringIO.StringIO(data))
 
 
     def rotate(self, angle=0):
@@ -207,7 +383,7 @@ class Photo(object):
 
         if angle == 90:
             if imageCache is not None:
-                Exiftran.rotate90(self.fn)
+                self.transform(9)
                 newPixbuffer = self.scaledPixbuffer.rotate_simple(gtk.gdk.PIXBUF_ROTATE_CLOCKWISE)
                 logger.debug("rotate 90 of %s" % newPixbuffer)
                 self.pixelsX = y
@@ -215,12 +391,12 @@ class Photo(object):
                 if self.metadata is not None:
                     self.metadata["Resolution"] = "%i x % i" % (y, x)
             else:
-                Exiftran.rotate90(self.fn)
+                self.transform(9)
                 self.pixelsX = None
                 self.pixelsY = None
         elif angle == 270:
             if imageCache is not None:
-                Exiftran.rotate270(self.fn)
+                self.transform(2)
                 newPixbuffer = self.scaledPixbuffer.rotate_simple(gtk.gdk.PIXBUF_ROTATE_COUNTERCLOCKWISE)
                 logger.debug("rotate 270 of %s" % newPixbuffer)
                 self.pixelsX = y
@@ -228,20 +404,21 @@ class Photo(object):
                 if self.metadata is not None:
                     self.metadata["Resolution"] = "%i x % i" % (y, x)
             else:
-                Exiftran.rotate270(self.fn)
+                self.transform(2)
                 self.pixelsX = None
                 self.pixelsY = None
         elif angle == 180:
             if imageCache is not None:
-                Exiftran.rotate180(self.fn)
+                self.transform(1)
                 newPixbuffer = self.scaledPixbuffer.rotate_simple(gtk.gdk.PIXBUF_ROTATE_UPSIDEDOWN)
                 logger.debug("rotate 270 of %s" % newPixbuffer)
             else:
-                Exiftran.rotate180(self.fn)
+                self.transform(1)
                 self.pixelsX = None
                 self.pixelsY = None
         else:
             print "Erreur ! il n'est pas possible de faire une rotation de ce type sans perte de donnée."
+        metadataIndex.remove(self.filename)
         if imageCache is not None:
             self.scaledPixbuffer = newPixbuffer
             imageCache[self.filename] = self
@@ -251,8 +428,13 @@ class Photo(object):
     def removeFromCache(self):
         """remove the curent image from the Cache .... for various reasons"""
         if imageCache is not None:
-            if self.filename in imageCache.ordered:
-                imageCache.pop(self.filename)
+            imageCache.pop(self.filename, None)
+
+
+    def updateCache(self):
+        """update the cache entry of the current image (if any) so that its memory footprint is accounted"""
+        if (imageCache is not None) and (imageCache.get(self.filename) is not None):
+            imageCache[self.filename] = self
 
 
     def trash(self):
@@ -263,13 +445,17 @@ class Photo(object):
         if not op.isdir(td):
             makedir(td)
         shutil.move(self.fn, op.join(Trashdir, self.filename))
+        metadataIndex.remove(self.filename)
         logger.debug("sent %s to trash" % self.filename)
         self.removeFromCache()
 
 
-    def readExif(self):
+    def readExif(self, index=True):
         """
         return exif data + title from the photo
+        
+        @param index: use and update the MetadataIndex, False for files not yet 
+                      at their final place (i.e. during the import)
         """
         clef = {'Exif.Image.Make':'Marque',
  'Exif.Image.Model':'Modele',
@@ -284,15 +470,51 @@ class Photo(object):
 # 'Exif.Image.Orientation':'Orientation'
 }
 
+        if (self.metadata is None) and index:
+            indexed = metadataIndex.get(self.filename)
+            if indexed is not None:
+                self.metadata = indexed["metadata"]
+                self.orientation = indexed["orientation"]
+                if not (self._pixelsX and self._pixelsY) and indexed["width"] and indexed["height"]:
+                    self._pixelsX = indexed["width"]
+                    self._pixelsY = indexed["height"]
+                return self.metadata.copy()
+
         if self.metadata is None:
             self.metadata = {}
             self.metadata["Taille"] = "%.2f %s" % smartSize(op.getsize(self.fn))
+            header = exifreader.read(self.fn)
+            if header is not None:
+                #Only the header of the JPEG file was read, no pyexiv2
+                self.metadata["Titre"] = header["comment"]
+                rate = header.get("Exif.Image.Rating", 0)
+                if isinstance(rate, list):
+                    #tag with more than one value
+                    rate = rate[0]
+                self.metadata["Rate"] = int(rate)
+                if not (self._pixelsX and self._pixelsY):
+                    if "Exif.Photo.PixelXDimension" in header and "Exif.Photo.PixelYDimension" in header:
+                        self._pixelsX = header["Exif.Photo.PixelXDimension"]
+                        self._pixelsY = header["Exif.Photo.PixelYDimension"]
+                    elif "width" in header:
+                        self._pixelsX = header["width"]
+                        self._pixelsY = header["height"]
+                self.metadata["Resolution"] = "%s x %s " % (self.pixelsX, self.pixelsY)
+                self.orientation = header.get("Exif.Image.Orientation", self.orientation)
+                for key in clef:
+                    if key in header:
+                        self.metadata[clef[key]] = exifreader.humanValue(key, header[key]).decode(config.Coding).strip()
+                    else:
+                        self.metadata[clef[key]] = u""
+                if index:
+                    metadataIndex.put(self.filename, self.metadata, self._pixelsX, self._pixelsY, self.orientation)
+                return self.metadata.copy()
+
             self.metadata["Titre"] = self.exif.comment
             try:
                 rate = self.exif["Exif.Image.Rating"]
             except KeyError:
                 self.metadata["Rate"] = 0
-                self.exif["Exif.Image.Rating"] = 0
             else:
                 if "value" in dir(rate): # pyexiv2 v0.2+
                     self.metadata["Rate"] = int(rate.value)
@@ -321,6 +543,8 @@ class Photo(object):
                     self.metadata[clef[key]] = self.exif.interpretedExifValue(key).decode(config.Coding).strip()
                 except (IndexError, KeyError):
                     self.metadata[clef[key]] = u""
+            if index:
+                metadataIndex.put(self.filename, self.metadata, self._pixelsX, self._pixelsY, self.orientation)
         return self.metadata.copy()
 
 
@@ -336,6 +560,32 @@ class Photo(object):
             return False
 
 
+    def loadScaledPixbuffer(self):
+        """
+        Decode the image and scale it to the largest size ever displayed 
+        (config.ImageWidth x config.ImageHeight) to be kept in cache.
+        
+        This is safe to call from a non-GTK thread as it only deals with pixbufs.
+        @return: the scaled pixbuf 
+        """
+        if self.scaledPixbuffer is None:
+            logger.debug("self.scaledPixbuffer is empty")
+            Rbig = min(float(config.ImageWidth) / self.pixelsX, float(config.ImageHeight) / self.pixelsY)
+            if Rbig < 1:
+                nxBig = int(round(Rbig * self.pixelsX))
+                nyBig = int(round(Rbig * self.pixelsY))
+                pixbuf = pil2pixbuf(self.getReducedPIL(nxBig, nyBig))
+                if (pixbuf.get_width(), pixbuf.get_height()) == (nxBig, nyBig):
+                    self.scaledPixbuffer = pixbuf
+                else:
+                    self.scaledPixbuffer = pixbuf.scale_simple(nxBig, nyBig, gtkInterpolation[config.Interpolation])
+            else :
+                self.scaledPixbuffer = gtk.gdk.pixbuf_new_from_file(self.fn)
+            logger.debug("To Cached  %s, size (%i,%i)" % (self.filename, self.scaledPixbuffer.get_width(), self.scaledPixbuffer.get_height()))
+            self.updateCache()
+        return self.scaledPixbuffer
+
+
     def show(self, Xsize=600, Ysize=600):
         """
         return a pixbuf to shows the image in a Gtk window
@@ -347,15 +597,6 @@ class Photo(object):
         if Ysize > config.ImageHeight:
             config.ImageHeight = Ysize
 
-#        Prepare the big image to be put in cache
-        Rbig = min(float(config.ImageWidth) / self.pixelsX, float(config.ImageHeight) / self.pixelsY)
-        if Rbig < 1:
-            nxBig = int(round(Rbig * self.pixelsX))
-            nyBig = int(round(Rbig * self.pixelsY))
-        else:
-            nxBig = self.pixelsX
-            nyBig = self.pixelsY
-
         R = min(float(Xsize) / self.pixelsX, float(Ysize) / self.pixelsY)
         if R < 1:
             nx = int(round(R * self.pixelsX))
@@ -365,14 +606,7 @@ class Photo(object):
             ny = self.pixelsY
 
 #       Put in Cache the "BIG" image
-        if self.scaledPixbuffer is None:
-            logger.debug("self.scaledPixbuffer is empty")
-            pixbuf = gtk.gdk.pixbuf_new_from_file(self.fn)
-            if Rbig < 1:
-                self.scaledPixbuffer = pixbuf.scale_simple(nxBig, nyBig, gtkInterpolation[config.Interpolation])
-            else :
-                self.scaledPixbuffer = pixbuf
-            logger.debug("To Cached  %s, size (%i,%i)" % (self.filename, nxBig, nyBig))
+        self.loadScaledPixbuffer()
         if (self.scaledPixbuffer.get_width() == nx) and (self.scaledPixbuffer.get_height() == ny):
             scaled_buf = self.scaledPixbuffer
             logger.debug("In cache No resize %s" % self.filename)
@@ -383,19 +617,29 @@ class Photo(object):
 
 
     def name(self, titre, rate=None):
-        """write the title of the photo inside the description field, in the JPEG header"""
+        """
+        write the title of the photo inside the description field, in the JPEG header.
+        The file itself is written in the background by the MetadataWriter.
+        """
         if os.name == 'nt' and self.pil != None:
             self.pil = None
         self.metadata["Titre"] = titre
+        exif = {}
         if rate is not None:
             self.metadata["Rate"] = rate
-            self.exif["Exif.Image.Rating"] = int(rate)
-        self.exif.comment = titre
-        try:
-            self.exif.write()
-        except IOError as error:
-            logger.warning("Got IO exception %s: file has probably changed:\n photo.name=%s\n exif.name=%s\n pil.name=%s" %
-                           (error, self.filename, self.exif.filename, self.pil.filename))
+            exif["Exif.Image.Rating"] = int(rate)
+        if self._exif is not None:
+            #keep the metadata already loaded up to date
+            self._exif.comment = titre
+            for key, value in exif.items():
+                self._exif[key] = value
+        metadataIndex.put(self.filename, self.metadata, self._pixelsX, self._pixelsY, self.orientation)
+        filename, metadata = self.filename, self.metadata.copy()
+        pixelsX, pixelsY, orientation = self._pixelsX, self._pixelsY, self.orientation
+        def reindex():
+            """update the modification time of the file in the index once written"""
+            metadataIndex.put(filename, metadata, pixelsX, pixelsY, orientation)
+        metadataWriter.put(self.fn, comment=titre, exif=exif, callback=reindex)
 
 
     def renameFile(self, newname):
@@ -408,12 +652,15 @@ class Photo(object):
         """
         oldname = self.filename
         newfn = op.join(config.DefaultRepository, newname)
+        metadataWriter.flush(self.fn)
         os.rename(self.fn, newfn)
         self.filename = newname
         self.fn = newfn
         self._exif = None
-        if (imageCache is not None) and (oldname in imageCache):
+        if imageCache is not None:
+            #no-op if the image is not (or no more) in the cache
             imageCache.rename(oldname, newname)
+        metadataIndex.rename(oldname, newname)
 
 
     def storeOriginalName(self, originalName):
@@ -424,8 +671,17 @@ class Photo(object):
         @param  originalName: name of the file before it was processed by selector
         @type   originalName: python string
         """
-        self.exif["Exif.Photo.UserComment"] = originalName
-        self.exif.write()
+        if self._exif is not None:
+            self._exif["Exif.Photo.UserComment"] = originalName
+        metadataWriter.put(self.fn, exif={"Exif.Photo.UserComment": originalName})
+
+
+    def flushMetadata(self):
+        """
+        Write now the metadata modified by name or storeOriginalName, 
+        instead of waiting for the background writer.
+        """
+        metadataWriter.flush(self.fn)
 
 
     def autorotate(self):
@@ -434,6 +690,7 @@ class Photo(object):
             del self.pil
         self.readExif()
         if self.orientation != 1:
+            metadataWriter.flush(self.fn)
             Exiftran.autorotate(self.fn)
             if self.orientation > 4:
                 self.pixelsX = self.exif["Exif.Photo.PixelYDimension"]
@@ -464,18 +721,13 @@ class Photo(object):
         dimX, dimY = self.pil.size
 
         ImageFile.MAXBLOCK = dimX * dimY
-        img_array = numpy.fromstring(self.pil.tostring(), dtype="UInt8").astype("float32")
+        img_array = numpy.fromstring(self.pil.tostring(), dtype="uint8")
         img_array.shape = (dimY, dimX, 3)
-        red, green, blue = img_array[:, :, 0], img_array[:, :, 1], img_array[:, :, 2]
-        #nota: this is faster than desat2=(ar.max(axis=2)+ar.min(axis=2))/2
-        desat_array = (numpy.minimum(numpy.minimum(red, green), blue) + numpy.maximum(numpy.maximum(red, green), blue)) / 2.0
-        inv_desat = 255. - desat_array
-        blured_inv_desat = self._gaussian.blur(inv_desat, config.ContrastMaskGaussianSize)
-        bisi = numpy.round(blured_inv_desat).astype("uint8")
-        k = Image.fromarray(bisi, "L").convert("RGB")
-        S = ImageChops.screen(self.pil, k)
-        M = ImageChops.multiply(self.pil, k)
-        F = ImageChops.add(ImageChops.multiply(self.pil, S), ImageChops.multiply(ImageChops.invert(self.pil), M))
+        nbThreads = config.NbrWorkers
+        if nbThreads <= 0:
+            nbThreads = multiprocessing.cpu_count()
+        out_array = contrastMaskTiles(img_array, config.ContrastMaskGaussianSize, self._gaussian, nbThreads=nbThreads)
+        F = Image.fromstring("RGB", (dimX, dimY), out_array.tostring())
         exitJpeg = op.join(config.DefaultRepository, outfile)
         F.save(exitJpeg, quality=80, progressive=True, Optimize=True)
         try:
@@ -520,18 +772,24 @@ class Photo(object):
             return
         t0 = time.time()
         position = 5e-4
-        rgb1 = numpy.fromstring(self.pil.tostring(), dtype="uint8")
-        rgb1.shape = -1, 3
-        rgb = rgb1.astype("float32")
-        rgb1.sort(axis=0)
-        pos_min = int(round(rgb1.shape[0] * position))
-        pos_max = rgb1.shape[0] - pos_min
-        rgb_min = rgb1[pos_min]
-        rgb_max = rgb1[pos_max]
-        rgb[:, 0] = 255.0 * (rgb[:, 0].clip(rgb_min[0], rgb_max[0]) - rgb_min[0]) / (rgb_max[0] - rgb_min[0])
-        rgb[:, 1] = 255.0 * (rgb[:, 1].clip(rgb_min[1], rgb_max[1]) - rgb_min[1]) / (rgb_max[1] - rgb_min[1])
-        rgb[:, 2] = 255.0 * (rgb[:, 2].clip(rgb_min[2], rgb_max[2]) - rgb_min[2]) / (rgb_max[2] - rgb_min[2])
-        out = Image.fromstring("RGB", (self.pixelsX, self.pixelsY), rgb.round().astype("uint8").tostring())
+        img = self.pil
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # percentiles from the cumulated 256-bin histogram of each channel
+        hist = numpy.array(img.histogram(), dtype="int64").reshape(3, 256)
+        npix = hist[0].sum()
+        pos_min = int(round(npix * position))
+        pos_max = npix - pos_min
+        lut = []
+        for channel in hist:
+            cumul = channel.cumsum()
+            rgb_min = min(255, numpy.searchsorted(cumul, pos_min, side="right"))
+            rgb_max = min(255, numpy.searchsorted(cumul, pos_max, side="right"))
+            values = numpy.arange(256, dtype="float32")
+            if rgb_max > rgb_min:
+                values = 255.0 * (values.clip(rgb_min, rgb_max) - rgb_min) / numpy.float32(rgb_max - rgb_min)
+            lut += [int(i) for i in values.round()]
+        out = img.point(lut)
         exitJpeg = op.join(config.DefaultRepository, outfile)
         out.save(exitJpeg, quality=80, progressive=True, Optimize=True)
         try:
@@ -552,9 +810,18 @@ class Photo(object):
 ########################################################
 
 class Signature(object):
-    def __init__(self, filename):
+    """
+    Watermark of the images with a signature, subtracted from the image in one 
+    of its corners (or sides, or center). Only the area covered by the 
+    signature is processed, with a signature tile converted once per image mode
+    and the placements kept in a small LRU cache.
+    """
+    def __init__(self, filename, maxSize=16):
         """
         this filter allows add a signature to an image
+        
+        @param filename: path of the signature image
+        @param maxSize: number of placements (image size, orientation, mode) to keep in cache
         """
         self.img = None
         self.sig = Image.open(filename)
@@ -567,50 +834,105 @@ class Signature(object):
 
         self.orientation = -1 #this is an impossible value
         (self.x, self.y) = (self.xs, self.ys)
+        self.maxSize = maxSize
+        self.tiles = OrderedDict()
+        self.sigModes = {self.sig.mode: self.sig}
+        self.lock = threading.Lock()
 
-    def mask(self, orientation=5):
+    def box(self, orientation=5):
         """
-        x and y are the size of the initial image
+        Position of the signature in an image of size (self.x, self.y)
         the orientation correspond to the position on a clock :
         0 for the center
         1 or 2 upper right
-        3 centered in heith right side ...."""
+        3 centered in heith right side ....
+        
+        @return: the box (left, upper, right, lower) or None if the signature does not fit in the image
+        """
+        if self.x < self.xs or self.y < self.ys :
+            #the signature is larger than the image
+            return
+        if orientation == 0:
+            return (self.x / 2 - self.xs / 2, self.y / 2 - self.ys / 2, self.x / 2 - self.xs / 2 + self.xs, self.y / 2 - self.ys / 2 + self.ys)
+        elif orientation in [1, 2]:
+            return (self.x - self.xs, 0, self.x, self.ys)
+        elif orientation == 3:
+            return (self.x - self.xs, self.y / 2 - self.ys / 2, self.x, self.y / 2 - self.ys / 2 + self.ys)
+        elif orientation in [ 5, 4]:
+            return (self.x - self.xs, self.y - self.ys, self.x, self.y)
+        elif orientation == 6:
+            return (self.x / 2 - self.xs / 2, self.y - self.ys, self.x / 2 - self.xs / 2 + self.xs, self.y)
+        elif orientation in [7, 8]:
+            return (0, self.y - self.ys, self.xs, self.y)
+        elif orientation == 9:
+            return (0, self.y / 2 - self.ys / 2, self.xs, self.y / 2 - self.ys / 2 + self.ys)
+        elif orientation in [10, 11]:
+            return (0, 0, self.xs, self.ys)
+        elif orientation == 12:
+            return (self.x / 2 - self.xs / 2, 0, self.x / 2 - self.xs / 2 + self.xs, self.ys)
+
+    def mask(self, orientation=5):
+        """
+        Build the full size mask (self.bigsig) for an image of size (self.x, self.y).
+        It is not needed by substract any more, which works on the signature area only.
+        """
         if orientation == self.orientation and (self.x, self.y) == self.bigsig.size:
             #no need to change the mask
             return
         self.orientation = orientation
         self.bigsig = Image.new("RGB", (self.x, self.y), (0, 0, 0))
-        if self.x < self.xs or self.y < self.ys :
-            #the signature is larger than the image
-            return
-        if self.orientation == 0:
-            self.bigsig.paste(self.sig, (self.x / 2 - self.xs / 2, self.y / 2 - self.ys / 2, self.x / 2 - self.xs / 2 + self.xs, self.y / 2 - self.ys / 2 + self.ys))
-        elif self.orientation in [1, 2]:
-            self.bigsig.paste(self.sig, (self.x - self.xs, 0, self.x, self.ys))
-        elif self.orientation == 3:
-            self.bigsig.paste(self.sig, (self.x - self.xs, self.y / 2 - self.ys / 2, self.x, self.y / 2 - self.ys / 2 + self.ys))
-        elif self.orientation in [ 5, 4]:
-            self.bigsig.paste(self.sig, (self.x - self.xs, self.y - self.ys, self.x, self.y))
-        elif self.orientation == 6:
-            self.bigsig.paste(self.sig, (self.x / 2 - self.xs / 2, self.y - self.ys, self.x / 2 - self.xs / 2 + self.xs, self.y))
-        elif self.orientation in [7, 8]:
-            self.bigsig.paste(self.sig, (0, self.y - self.ys, self.xs, self.y))
-        elif self.orientation == 9:
-            self.bigsig.paste(self.sig, (0, self.y / 2 - self.ys / 2, self.xs, self.y / 2 - self.ys / 2 + self.ys))
-        elif self.orientation in [10, 11]:
-            self.bigsig.paste(self.sig, (0, 0, self.xs, self.ys))
-        elif self.orientation == 12:
-            self.bigsig.paste(self.sig, (self.x / 2 - self.xs / 2, 0, self.x / 2 - self.xs / 2 + self.xs, self.ys))
+        box = self.box(orientation)
+        if box is not None:
+            self.bigsig.paste(self.sig, box)
         return
 
-    def substract(self, inimage, orientation=5):
-        """apply a substraction mask on the image"""
+    def tile(self, size, orientation, mode):
+        """
+        Retrieve from the LRU cache the placement of the signature in an image
+        
+        @param size: size of the image
+        @param orientation: position of the signature (see box)
+        @param mode: mode of the image
+        @return: 2-tuple box, signature in this mode (or None, None) 
+        """
+        key = (size, orientation, mode)
+        with self.lock:
+            if key in self.tiles:
+                value = self.tiles.pop(key)
+                self.tiles[key] = value
+                return value
+            self.x, self.y = size
+            box = self.box(orientation)
+            if box is None:
+                value = (None, None)
+            else:
+                if mode not in self.sigModes:
+                    self.sigModes[mode] = self.sig.convert(mode)
+                value = (box, self.sigModes[mode])
+            self.tiles[key] = value
+            while len(self.tiles) > self.maxSize:
+                self.tiles.popitem(last=False)
+            return value
+
+    def substract(self, inimage, orientation=5, inplace=False):
+        """
+        apply a substraction mask on the image
+        
+        @param inimage: PIL image
+        @param orientation: position of the signature (see box)
+        @param inplace: modify inimage instead of a copy of it 
+        @return: the signed image
+        """
         self.img = inimage
-        self.x, self.y = self.img.size
-        ImageFile.MAXBLOCK = self.x * self.y
-        self.mask(orientation)
-        k = ImageChops.difference(self.img, self.bigsig)
-        return k
+        ImageFile.MAXBLOCK = inimage.size[0] * inimage.size[1]
+        box, sig = self.tile(inimage.size, orientation, inimage.mode)
+        if inplace:
+            out = inimage
+        else:
+            out = inimage.copy()
+        if box is not None:
+            out.paste(ImageChops.difference(out.crop(box), sig), box)
+        return out
 
 
 class RawImage:
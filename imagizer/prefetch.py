@@ -0,0 +1,192 @@
+#!/usr/bin/env python 
+# -*- coding: UTF8 -*-
+#******************************************************************************\
+#* $Source$
+#* $Id$
+#*
+#* Copyright (C) 2006-2011,  Jérome Kieffer <kieffer@terre-adelie.org>
+#* Conception : Jérôme KIEFFER, Mickael Profeta & Isabelle Letard
+#* Licence GPL v2
+#*
+#* This program is free software; you can redistribute it and/or modify
+#* it under the terms of the GNU General Public License as published by
+#* the Free Software Foundation; either version 2 of the License, or
+#* (at your option) any later version.
+#*
+#* This program is distributed in the hope that it will be useful,
+#* but WITHOUT ANY WARRANTY; without even the implied warranty of
+#* MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#* GNU General Public License for more details.
+#*
+#* You should have received a copy of the GNU General Public License
+#* along with this program; if not, write to the Free Software
+#* Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#*
+#*****************************************************************************/
+
+
+"""
+Prefetcher decodes and pre-scales in a background thread the images 
+next to the one displayed, and stores them in the ImageCache so that
+moving to the next/previous image only costs a cache lookup.
+"""
+__author__ = "Jérôme Kieffer"
+__contact__ = "imagizer@terre-adelie.org"
+__date__ = "20121018"
+__license__ = "GPL"
+
+import logging, threading
+logger = logging.getLogger("imagizer.prefetch")
+from config import Config
+config = Config()
+from photo import Photo, imageCache
+
+
+class Prefetcher(object):
+    """
+    Background worker populating the ImageCache with the neighbours of the current image.
+    
+    It is direction-aware: the images ahead in the direction of travel are decoded first,
+    followed by the previous one. 
+    Cancellation rule: every new position replaces the list of pending images, 
+    and a jump (larger than the prefetch depth, i.e. nextJ, searchJ, ...) drops them immediately.
+    """
+    #all the prefetchers of the process, see pauseAll
+    instances = []
+
+    def __init__(self, depth=None):
+        """
+        @param depth: number of images to prefetch ahead, config.PrefetchDepth by default
+        """
+        if depth is None:
+            depth = config.PrefetchDepth
+        self.depth = depth
+        self.pending = []
+        self.lastIndex = None
+        self.direction = 1
+        self.condition = threading.Condition()
+        self.paused = False
+        self.working = False
+        self.thread = None
+        Prefetcher.instances.append(self)
+        if (self.depth > 0) and (imageCache is not None):
+            self.thread = threading.Thread(target=self.run, name="Prefetcher")
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+
+    def schedule(self, lstFiles, index):
+        """
+        Called each time an image is displayed: queue its neighbours for decoding
+        
+        @param lstFiles: list of all images (AllJpegs)
+        @param index: index of the image currently displayed
+        """
+        if self.thread is None or not lstFiles:
+            return
+        nbFiles = len(lstFiles)
+        if self.lastIndex is not None:
+            delta = index - self.lastIndex
+            #take care of the wrapping at the end of the list
+            if delta > nbFiles // 2:
+                delta -= nbFiles
+            elif delta < -(nbFiles // 2):
+                delta += nbFiles
+            if abs(delta) > self.depth:
+                logger.debug("Prefetcher.schedule: jump of %i images, dropping stale prefetches" % delta)
+                self.cancel()
+            if delta > 0:
+                self.direction = 1
+            elif delta < 0:
+                self.direction = -1
+        self.lastIndex = index
+        todo = [lstFiles[(index + self.direction * i) % nbFiles] for i in range(1, self.depth + 1)]
+        todo.append(lstFiles[(index - self.direction) % nbFiles])
+        current = lstFiles[index]
+        with self.condition:
+            self.pending = [i for i in todo if i != current]
+            self.condition.notifyAll()
+
+
+    def cancel(self):
+        """
+        Drop all pending prefetches
+        """
+        with self.condition:
+            self.pending = []
+
+
+    def pause(self):
+        """
+        Drop all pending prefetches and wait for the image being decoded, if any: 
+        the thread then holds no lock until resume is called
+        """
+        with self.condition:
+            self.paused = True
+            self.pending = []
+            while self.working:
+                self.condition.wait()
+
+
+    def resume(self):
+        """
+        Allow prefetching again after pause
+        """
+        with self.condition:
+            self.paused = False
+            self.condition.notifyAll()
+
+
+    @classmethod
+    def pauseAll(cls):
+        """
+        Pause all the prefetchers, i.e. before forking processes
+        """
+        for prefetcher in cls.instances:
+            prefetcher.pause()
+
+
+    @classmethod
+    def resumeAll(cls):
+        """
+        Resume all the prefetchers
+        """
+        for prefetcher in cls.instances:
+            prefetcher.resume()
+
+
+    def run(self):
+        """
+        Main loop of the prefetching thread
+        """
+        while True:
+            with self.condition:
+                while self.paused or not self.pending:
+                    self.condition.wait()
+                filename = self.pending.pop(0)
+                self.working = True
+            try:
+                self.prefetch(filename)
+            except Exception as error:
+                logger.warning("Prefetcher: unable to prefetch %s: %s" % (filename, error))
+            with self.condition:
+                self.working = False
+                self.condition.notifyAll()
+
+
+    def prefetch(self, filename):
+        """
+        Decode and pre-scale one image into the cache
+        
+        @param filename: name of the image, starting from the repository root
+        """
+        if (config.ImageWidth is None) or (config.ImageHeight is None):
+            #nothing displayed yet: we do not know the size to scale to
+            return
+        cached = imageCache.get(filename)
+        if (cached is not None) and (cached.scaledPixbuffer is not None):
+            return
+        logger.debug("Prefetcher.prefetch %s" % filename)
+        photo = Photo(filename)
+        photo.readExif()
+        photo.loadScaledPixbuffer()
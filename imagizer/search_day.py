@@ -25,14 +25,18 @@
 #*****************************************************************************/
 """
 Module containing most a class for searching a day in all
+
+Titles and comments of the days are indexed (words -> days) in DayIndex, 
+which is saved at the root of the repository: a search only looks up the
+words starting with the terms and the days in the range of dates.
 """
 
 __author__ = "Jérôme Kieffer"
 __contact__ = "imagizer@terre-adelie.org"
-__date__ = "20120415"
+__date__ = "20121018"
 __license__ = "GPL"
 
-import os, logging, time
+import os, logging, time, re, json, bisect, threading
 import os.path as op
 installdir = op.dirname(__file__)
 logger = logging.getLogger("imagizer.search")
@@ -56,6 +60,190 @@ try:
 except ImportError:
     logger.debug("No socket opened for debugging -> please install rfoo")
 
+def tokenize(text):
+    """
+    Split a title or a comment into words, lower case without accents
+    
+    @param text: unicode or string in config.Coding
+    @return: list of words
+    """
+    if not text:
+        return []
+    return [word for word in re.split("[^a-z0-9]+", unicode2ascii(toUnicode(text).lower())) if word]
+
+
+def toUnicode(text):
+    """
+    @param text: unicode, string in config.Coding or None
+    @return: unicode string, undecodable characters being replaced
+    """
+    if text is None:
+        return u""
+    if isinstance(text, str):
+        return text.decode(config.Coding, "replace")
+    return text
+
+
+class DayIndex(object):
+    """
+    Inverted index of the titles and comments of the days: for each field, 
+    word -> set of days (name of the directory).
+    The content of each day is also saved with the modification time of its 
+    index.desc so that unchanged days are not parsed again.
+    
+    this class is a Borg : always returns the same values regardless to the instance of the object
+    """
+    __shared_state = {}
+    __data_initialized = False
+    filename = ".imagizer-days.json"
+    fields = ("title", "comment")
+
+    def __init__(self):
+        """
+        Constructor of DayIndex: the index is read on first use
+        """
+        self.__dict__ = self.__shared_state
+        if  DayIndex.__data_initialized is False:
+            DayIndex.__data_initialized = True
+            logger.debug("DayIndex.__init__: initalization of the Borg")
+            self.lock = threading.RLock()
+            self.path = None
+            self.days = {}
+            self.words = dict((field, {}) for field in self.fields)
+            self.sortedWords = {}
+            self.modified = False
+
+    def load(self):
+        """
+        Read the index of the current repository
+        """
+        path = os.path.join(config.DefaultRepository, self.filename)
+        with self.lock:
+            if path == self.path:
+                return
+            self.path = path
+            self.days = {}
+            self.words = dict((field, {}) for field in self.fields)
+            self.sortedWords = {}
+            self.modified = False
+            if not os.path.isfile(path):
+                return
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                self.days = {}
+                for key, entry in data["days"].items():
+                    #title and comment are unicode, names of files are byte strings like os.listdir
+                    if entry.get("picture") is not None:
+                        entry["picture"] = entry["picture"].encode(config.Coding)
+                    self.days[key.encode(config.Coding)] = entry
+                for field in self.fields:
+                    self.words[field] = dict((str(word), set(day.encode(config.Coding) for day in days))
+                                             for word, days in data["words"][field].items())
+            except (IOError, ValueError, KeyError, UnicodeError) as error:
+                logger.warning("DayIndex: unable to read %s: %s" % (path, error))
+                self.days = {}
+                self.words = dict((field, {}) for field in self.fields)
+
+    def save(self):
+        """
+        Write the index if it was modified
+        """
+        with self.lock:
+            if not self.modified or self.path is None:
+                return
+            data = {"days": self.days,
+                    "words": dict((field, dict((word, sorted(days)) for word, days in self.words[field].items()))
+                                  for field in self.fields)}
+            try:
+                with open(self.path + ".tmp", "w") as f:
+                    json.dump(data, f, encoding=config.Coding)
+                os.rename(self.path + ".tmp", self.path)
+            except (IOError, OSError, ValueError, UnicodeError) as error:
+                logger.warning("DayIndex: unable to write %s: %s" % (self.path, error))
+            else:
+                self.modified = False
+
+    def get(self, dirname, mtime):
+        """
+        @param dirname: name of the directory of the day
+        @param mtime: modification time of its index.desc (None if missing)
+        @return: dictionary with title, comment and picture or None if not indexed or outdated
+        """
+        self.load()
+        with self.lock:
+            entry = self.days.get(dirname)
+        if entry is not None and entry["mtime"] == mtime:
+            return entry
+
+    def put(self, dirname, mtime, title, comment, picture):
+        """
+        Index a day
+        
+        @param dirname: name of the directory of the day
+        @param mtime: modification time of its index.desc (None if missing)
+        @param title, comment: title and comment of the day, converted to unicode
+        @param picture: image representing the day (from index.desc) or None 
+        """
+        self.load()
+        entry = {"mtime": mtime, "title": toUnicode(title), "comment": toUnicode(comment), "picture": picture}
+        with self.lock:
+            old = self.days.get(dirname)
+            if old is not None:
+                for field in self.fields:
+                    for word in tokenize(old[field]):
+                        days = self.words[field].get(word)
+                        if days is not None:
+                            days.discard(dirname)
+                            if not days:
+                                del self.words[field][word]
+            for field in self.fields:
+                for word in tokenize(entry[field]):
+                    self.words[field].setdefault(word, set()).add(dirname)
+            self.days[dirname] = entry
+            self.sortedWords = {}
+            self.modified = True
+
+    def lookup(self, field, term):
+        """
+        @param field: "title" or "comment"
+        @param term: beginning of a word, as returned by tokenize
+        @return: set of the days with a word starting with the term in this field 
+        """
+        with self.lock:
+            if field not in self.sortedWords:
+                self.sortedWords[field] = sorted(self.words[field])
+            words = self.sortedWords[field]
+            result = set()
+            idx = bisect.bisect_left(words, term)
+            while idx < len(words) and words[idx].startswith(term):
+                result.update(self.words[field][words[idx]])
+                idx += 1
+        return result
+
+    def search(self, days, begin, end, inTitle=None, inComment=None):
+        """
+        Search the days between two dates with any of the terms in their title or comment
+        
+        @param days: sorted list of the days (name of the directories) to consider 
+        @param begin, end: dates as "YYYY-MM-DD"
+        @param inTitle: list of terms searched in titles 
+        @param inComment: list of terms searched in comments
+        @return: sorted list of matching days
+        """
+        inRange = days[bisect.bisect_left(days, begin):bisect.bisect_right(days, end + "\xff")]
+        terms = [("title", term) for term in (inTitle or [])] + [("comment", term) for term in (inComment or [])]
+        if not terms:
+            return inRange
+        found = set()
+        for field, term in terms:
+            found.update(self.lookup(field, term))
+        return [day for day in inRange if day in found]
+
+
+dayIndex = DayIndex()
+
+
 class Day(object):
     """class containing metadata for a directory"""
     cache = {}
@@ -68,7 +256,20 @@ class Day(object):
 #            if not "year" in self.__dict__:
             self.year = self.month = self.day = self.comment = self.title = self.comment = self.picture = None
             self.analyse_name(self.dirname)
-            self.analyse_comments()
+            indexfile = os.path.join(config.DefaultRepository, self.dirname, "index.desc")
+            try:
+                mtime = os.stat(indexfile).st_mtime
+            except OSError:
+                mtime = None
+            indexed = dayIndex.get(self.dirname, mtime)
+            if indexed is not None:
+                self.title = indexed["title"]
+                self.comment = indexed["comment"]
+                self.picture = indexed["picture"] or self.filename
+            else:
+                self.analyse_comments()
+                picture = None if self.picture == self.filename else self.picture
+                dayIndex.put(self.dirname, mtime, self.title, self.comment, picture)
             self.__class__.cache[self.dirname] = self.__dict__
 
     def __repr__(self):
@@ -108,6 +309,11 @@ class Day(object):
             self.picture = self.filename
             self.title = ""
             self.comment = ""
+        #title and comment are always unicode, as read back from the index
+        self.title = toUnicode(self.title)
+        self.comment = toUnicode(self.comment)
+        if isinstance(self.picture, unicode):
+            self.picture = self.picture.encode(config.Coding)
 
     def getdate(self):
         return [self.year, self.month, self.day]
@@ -158,6 +364,7 @@ class SearchDay(object):
         self.xml.signal_autoconnect(dictSignals)
         for img in lst_photo:
             a = Day(img)
+        dayIndex.save()
         self.days = list(a.__class__.cache.keys())
         self.days.sort()
         first = Day.get(self.days[0])
@@ -195,27 +402,10 @@ class SearchDay(object):
         if end < begin:
             logger.warning("End date more recent than start time !!!")
             return
-        inTitle = unicode2ascii(self.xml.get_widget("InTitle").get_text().lower()).split()
-        inComment = unicode2ascii(self.xml.get_widget("InComment").get_text().lower()).split()
+        inTitle = tokenize(self.xml.get_widget("InTitle").get_text())
+        inComment = tokenize(self.xml.get_widget("InComment").get_text())
         t0 = time.time()
-        match = []
-        for d in self.days:
-            date = d[:10]
-            if (end >= date >= begin):
-                if len(inTitle) + len(inComment) == 0:
-                    match.append(d)
-                else:
-                    day = Day.get(d)
-                    good = False
-                    for k in inTitle:
-                        if k and (k in unicode2ascii(day.title.lower())):
-                            good = True
-                    if not good:
-                        for k in inComment:
-                            if k and (k in unicode2ascii(day.comment.lower())):
-                                good = True
-                    if good:
-                        match.append(d)
+        match = dayIndex.search(self.days, begin, end, inTitle, inComment)
         logger.info("search took %.3f" , (time.time() - t0))
         self.store = gtk.ListStore(str, str, str, str)
         for i in match:
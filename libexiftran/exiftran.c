@@ -110,6 +110,35 @@ usage(FILE *fp, char *name)
 	    name);
 }
 
+/* transformation corresponding to the actions of pylib */
+static JXFORM_CODE action_transform(int action)
+{
+    switch (action) {
+    case 9:
+	return JXFORM_ROT_90;
+    case 1:
+	return JXFORM_ROT_180;
+    case 2:
+	return JXFORM_ROT_270;
+    case 0:
+	return -1; /* automagic */
+    }
+    return JXFORM_NONE;
+}
+
+/* same as pylib on a JPEG image in memory: *out is allocated and must be freed */
+int pylib_mem(int action, unsigned char *in, size_t isize,
+	      unsigned char **out, size_t *osize)
+{
+    unsigned int flags =
+	JFLAG_TRANSFORM_IMAGE     |
+	JFLAG_TRANSFORM_THUMBNAIL |
+	JFLAG_UPDATE_ORIENTATION;
+
+    return jpeg_transform_mem(in, isize, out, osize,
+			      action_transform(action), NULL, NULL, 0, flags);
+}
+
 int pylib(int action, char *name)
 {
     JXFORM_CODE transform = JXFORM_NONE;
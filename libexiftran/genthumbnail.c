@@ -4,6 +4,7 @@
 #include <unistd.h>
 #include <errno.h>
 #include <string.h>
+#include <setjmp.h>
 
 #include <jpeglib.h>
 #include "transupp.h"		/* Support routines for jpegtran */
@@ -17,33 +18,74 @@
 
 /* ---------------------------------------------------------------------- */
 
+struct scaled_err {
+    struct jpeg_error_mgr jpeg;
+    jmp_buf setjmp_buffer;
+};
+
+static void scaled_error_exit(j_common_ptr cinfo)
+{
+    struct scaled_err *h = (struct scaled_err *)cinfo->err;
+    (*cinfo->err->output_message)(cinfo);
+    longjmp(h->setjmp_buffer, 1);
+}
+
+/*
+ * read a JPEG file at reduced size: libjpeg decodes directly at 1/2, 1/4 
+ * or 1/8 of the size when the image remains larger than what is needed
+ * to make a thumbnail fitting in a max x max box.
+ */
 static struct ida_image*
-read_jpeg(char *filename)
+read_jpeg_scaled(char *filename, int max)
 {
-    struct ida_image *img;
+    struct jpeg_decompress_struct cinfo;
+    struct scaled_err jerr;
+    struct ida_image * volatile img = NULL; /* used after longjmp */
+    JSAMPROW row;
     FILE *fp;
-    unsigned int y;
-    void *data;
-    
-    /* open file */
+    unsigned int denom, biggest;
+
     if (NULL == (fp = fopen(filename, "r"))) {
 	fprintf(stderr,"open %s: %s\n",filename,strerror(errno));
 	return NULL;
     }
+    cinfo.err = jpeg_std_error(&jerr.jpeg);
+    jerr.jpeg.error_exit = scaled_error_exit;
+    if (setjmp(jerr.setjmp_buffer)) {
+	jpeg_destroy_decompress(&cinfo);
+	fclose(fp);
+	if (img) {
+	    free(img->data);
+	    free(img);
+	}
+	return NULL;
+    }
+    jpeg_create_decompress(&cinfo);
+    jpeg_stdio_src(&cinfo, fp);
+    jpeg_read_header(&cinfo, TRUE);
+
+    biggest = (cinfo.image_width > cinfo.image_height) ? cinfo.image_width : cinfo.image_height;
+    for (denom = 8; denom > 1; denom /= 2)
+	if (biggest >= denom * max)
+	    break;
+    cinfo.scale_num = 1;
+    cinfo.scale_denom = denom;
+    cinfo.out_color_space = JCS_RGB;
+    jpeg_start_decompress(&cinfo);
 
-    /* load image */
     img = malloc(sizeof(*img));
     memset(img,0,sizeof(*img));
-    data = jpeg_loader.init(fp,filename,0,&img->i,0);
-    if (NULL == data) {
-	fprintf(stderr,"loading %s [%s] FAILED\n",filename,jpeg_loader.name);
-	free(img);
-	return NULL;
-    }
+    img->i.width  = cinfo.output_width;
+    img->i.height = cinfo.output_height;
+    img->i.npages = 1;
     img->data = malloc(img->i.width * img->i.height * 3);
-    for (y = 0; y < img->i.height; y++)
-  	jpeg_loader.read(img->data + img->i.width * 3 * y, y, data);
-    jpeg_loader.done(data);
+    while (cinfo.output_scanline < cinfo.output_height) {
+	row = img->data + img->i.width * 3 * cinfo.output_scanline;
+	jpeg_read_scanlines(&cinfo, &row, 1);
+    }
+    jpeg_finish_decompress(&cinfo);
+    jpeg_destroy_decompress(&cinfo);
+    fclose(fp);
     return img;
 }
 
@@ -91,6 +133,7 @@ scale_thumbnail(struct ida_image *src, int max)
 struct thc {
     struct jpeg_compress_struct dst;
     struct jpeg_error_mgr err;
+    struct jpeg_destination_mgr mgr; /* private copy: several threads may run at once */
     unsigned char *out;
     int osize;
 };
@@ -121,7 +164,8 @@ static struct jpeg_destination_mgr thumbnail_dst = {
 };
 
 static int
-compress_thumbnail(struct ida_image *img, char *dest, int max)
+compress_thumbnail(struct ida_image *img, char *dest, int max,
+		   int quality, int progressive, int optimize)
 {
     struct thc thc;
     unsigned char *line;
@@ -130,7 +174,8 @@ compress_thumbnail(struct ida_image *img, char *dest, int max)
     memset(&thc,0,sizeof(thc));
     thc.dst.err = jpeg_std_error(&thc.err);
     jpeg_create_compress(&thc.dst);
-    thc.dst.dest = &thumbnail_dst;
+    thc.mgr = thumbnail_dst;
+    thc.dst.dest = &thc.mgr;
     thc.out = dest;
     thc.osize = max;
 
@@ -139,6 +184,11 @@ compress_thumbnail(struct ida_image *img, char *dest, int max)
     thc.dst.input_components = 3;
     thc.dst.in_color_space = JCS_RGB;
     jpeg_set_defaults(&thc.dst);
+    if (quality > 0)
+	jpeg_set_quality(&thc.dst, quality, TRUE);
+    if (progressive)
+	jpeg_simple_progression(&thc.dst);
+    thc.dst.optimize_coding = optimize ? TRUE : FALSE;
     jpeg_start_compress(&thc.dst, TRUE);
 
     for (i = 0, line = img->data; i < img->i.height; i++, line += img->i.width*3)
@@ -152,35 +202,54 @@ compress_thumbnail(struct ida_image *img, char *dest, int max)
 
 /* ---------------------------------------------------------------------- */
 
-int create_thumbnail(char *filename, unsigned char *dest, int max)
+unsigned char *create_thumbnail_mem(char *filename, int size, int quality,
+				    int progressive, int optimize, int *osize)
 {
     struct ida_image *img,*thumb;
-    int size;
+    unsigned char *dest;
+    int max;
 
-    //fprintf(stderr,"%s: read ",filename);
-    img = read_jpeg(filename);
+    *osize = -1;
+    img = read_jpeg_scaled(filename, size);
     if (!img) {
 	fprintf(stderr,"FAILED\n");
-	return -1;
+	return NULL;
     }
     
-    //fprintf(stderr,"scale ");
-    thumb = scale_thumbnail(img,160);
+    thumb = scale_thumbnail(img, size);
+    free(img->data);
+    free(img);
     if (!thumb) {
-	free(img->data);
-	free(img);
 	fprintf(stderr,"FAILED\n");
-	return -1;
+	return NULL;
     }
 
-    //fprintf(stderr,"compress ");
-    size = compress_thumbnail(thumb,dest,max);
+    /* JPEG data never gets close to twice the raw size: the buffer cannot overflow */
+    max = 2 * thumb->i.width * thumb->i.height * 3 + 4096;
+    dest = malloc(max);
+    if (dest)
+	*osize = compress_thumbnail(thumb, (char *)dest, max, quality, progressive, optimize);
 
     /* cleanup */
-    free(img->data);
-    free(img);
     free(thumb->data);
     free(thumb);
+    return dest;
+}
+
+int create_thumbnail(char *filename, unsigned char *dest, int max)
+{
+    unsigned char *thumb;
+    int size;
+
+    thumb = create_thumbnail_mem(filename, 160, 0, 0, 0, &size);
+    if (!thumb)
+	return -1;
+    if (size > max) {
+	fprintf(stderr,"thumbnail of %s too large: %i bytes\n", filename, size);
+	size = -1;
+    } else
+	memcpy(dest, thumb, size);
+    free(thumb);
     return size;
 }
 
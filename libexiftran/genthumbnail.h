@@ -1 +1,3 @@
 int create_thumbnail(char *filename, unsigned char *dest, int max);
+unsigned char *create_thumbnail_mem(char *filename, int size, int quality,
+				    int progressive, int optimize, int *osize);
@@ -208,6 +208,8 @@ struct th {
     struct jpeg_decompress_struct src;
     struct jpeg_compress_struct   dst;
     struct jpeg_error_mgr jsrcerr, jdsterr;
+    struct jpeg_source_mgr srcmgr;      /* private copies of the managers: */
+    struct jpeg_destination_mgr dstmgr; /* several threads may run at once */
     unsigned char *in;
     unsigned char *out;
     int isize, osize;
@@ -286,12 +288,14 @@ static void do_thumbnail(ExifData *ed, JXFORM_CODE transform)
     /* setup src */
     th.src.err = jpeg_std_error(&th.jsrcerr);
     jpeg_create_decompress(&th.src);
-    th.src.src = &thumbnail_src;
+    th.srcmgr = thumbnail_src;
+    th.src.src = &th.srcmgr;
     
     /* setup dst */
     th.dst.err = jpeg_std_error(&th.jdsterr);
     jpeg_create_compress(&th.dst);
-    th.dst.dest = &thumbnail_dst;
+    th.dstmgr = thumbnail_dst;
+    th.dst.dest = &th.dstmgr;
 
     /* transform image */
     do_transform(&th.src,&th.dst,transform,NULL,NULL,0,JFLAG_TRANSFORM_IMAGE);
@@ -501,6 +505,46 @@ int jpeg_transform_fp(FILE *in, FILE *out,
     return -1;
 }
 
+int jpeg_transform_mem(unsigned char *in, size_t isize,
+		       unsigned char **out, size_t *osize,
+		       JXFORM_CODE transform,
+		       unsigned char *comment,
+		       char *thumbnail, int tsize,
+		       unsigned int flags)
+{
+    int rc;
+    FILE *fin;
+    FILE *fout;
+    char *buffer = NULL;
+    size_t size = 0;
+
+    *out = NULL;
+    *osize = 0;
+    fin = fmemopen(in, isize, "r");
+    if (NULL == fin) {
+	fprintf(stderr,"fmemopen: %s\n",strerror(errno));
+	return -1;
+    }
+    fout = open_memstream(&buffer, &size);
+    if (NULL == fout) {
+	fprintf(stderr,"open_memstream: %s\n",strerror(errno));
+	fclose(fin);
+	return -1;
+    }
+
+    /* go! */
+    rc = jpeg_transform_fp(fin,fout,transform,comment,thumbnail,tsize,flags);
+    fclose(fin);
+    fclose(fout);
+    if (0 != rc || 0 == size) {
+	free(buffer);
+	return -1;
+    }
+    *out = (unsigned char *)buffer;
+    *osize = size;
+    return 0;
+}
+
 int jpeg_transform_files(char *infile, char *outfile,
 			 JXFORM_CODE transform,
 			 unsigned char *comment,
@@ -16,6 +16,12 @@ int jpeg_transform_fp(FILE *in, FILE *out,
 		      unsigned char *comment,
 		      char *thumbnail, int tsize,
 		      unsigned int flags);
+int jpeg_transform_mem(unsigned char *in, size_t isize,
+		       unsigned char **out, size_t *osize,
+		       JXFORM_CODE transform,
+		       unsigned char *comment,
+		       char *thumbnail, int tsize,
+		       unsigned int flags);
 int jpeg_transform_files(char *infile, char *outfile,
 			 JXFORM_CODE transform,
 			 unsigned char *comment,
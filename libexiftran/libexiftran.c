@@ -1,4 +1,8 @@
 #include <Python.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <pthread.h>
 
 /* static variables */
 
@@ -6,7 +10,25 @@ static PyObject *exiftranError;
 
 /* Function declarations */
 
+int pylib(int action, char *name);
+int pylib_mem(int action, unsigned char *in, size_t isize,
+              unsigned char **out, size_t *osize);
+unsigned char *create_thumbnail_mem(char *filename, int size, int quality,
+                                    int progressive, int optimize, int *osize);
 static PyObject *libexiftran_run(PyObject *dummy, PyObject *args);
+static PyObject *libexiftran_run_batch(PyObject *dummy, PyObject *args);
+static PyObject *libexiftran_transform(PyObject *dummy, PyObject *args);
+static PyObject *libexiftran_thumbnail(PyObject *dummy, PyObject *args, PyObject *kwds);
+
+/* Work shared by the threads of run_batch */
+struct batch {
+    int nb;             /* number of files */
+    int next;           /* next file to process */
+    int *actions;
+    char **names;
+    int *results;
+    pthread_mutex_t lock;
+};
 
 /* ------------------------------------------------------- */
 static PyObject *
@@ -20,7 +42,7 @@ libexiftran_run(PyObject *self, PyObject *args)
         return NULL;
 //    printf("Got action=%i for filename %s\n",action,filename);
     Py_BEGIN_ALLOW_THREADS;
-    rc = pylib(action, filename);
+    rc = pylib(action, (char *)filename);
     Py_END_ALLOW_THREADS;
 
     if (rc!=0) printf("Error during libexiftran.run(%i,%s)",action,filename);
@@ -29,9 +51,196 @@ libexiftran_run(PyObject *self, PyObject *args)
 }
 
 
+/* ------------------------------------------------------- */
+static void *
+batch_worker(void *arg)
+{
+    struct batch *b = arg;
+    int i;
+
+    for (;;) {
+        pthread_mutex_lock(&b->lock);
+        i = b->next++;
+        pthread_mutex_unlock(&b->lock);
+        if (i >= b->nb)
+            break;
+        b->results[i] = pylib(b->actions[i], b->names[i]);
+    }
+    return NULL;
+}
+
+static PyObject *
+libexiftran_run_batch(PyObject *self, PyObject *args)
+{
+    PyObject *lst, *seq, *item, *ret = NULL;
+    struct batch b;
+    pthread_t *threads = NULL;
+    int nbthreads = 0, started = 0, i;
+    long ncpu;
+    char *name;
+
+    if (!PyArg_ParseTuple(args, "O|i", &lst, &nbthreads))
+        return NULL;
+    seq = PySequence_Fast(lst, "run_batch expects a list of (action, filename)");
+    if (seq == NULL)
+        return NULL;
+
+    memset(&b, 0, sizeof(b));
+    b.nb = PySequence_Fast_GET_SIZE(seq);
+    b.actions = calloc(b.nb + 1, sizeof(int));
+    b.results = calloc(b.nb + 1, sizeof(int));
+    b.names = calloc(b.nb + 1, sizeof(char *));
+    if (b.actions == NULL || b.results == NULL || b.names == NULL) {
+        PyErr_NoMemory();
+        goto cleanup;
+    }
+    /* copy the arguments: the GIL is released while they are used */
+    for (i = 0; i < b.nb; i++) {
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyArg_ParseTuple(item, "is", &b.actions[i], &name))
+            goto cleanup;
+        b.names[i] = strdup(name);
+        if (b.names[i] == NULL) {
+            PyErr_NoMemory();
+            goto cleanup;
+        }
+    }
+
+    if (nbthreads <= 0) {
+        ncpu = sysconf(_SC_NPROCESSORS_ONLN);
+        nbthreads = (ncpu > 0) ? (int)ncpu : 1;
+    }
+    if (nbthreads > b.nb)
+        nbthreads = b.nb;
+    threads = calloc(nbthreads + 1, sizeof(pthread_t));
+    if (threads == NULL) {
+        PyErr_NoMemory();
+        goto cleanup;
+    }
+
+    Py_BEGIN_ALLOW_THREADS;
+    pthread_mutex_init(&b.lock, NULL);
+    for (started = 0; started < nbthreads; started++)
+        if (pthread_create(&threads[started], NULL, batch_worker, &b) != 0)
+            break;
+    /* the current thread works as well, in case no thread could be started */
+    batch_worker(&b);
+    for (i = 0; i < started; i++)
+        pthread_join(threads[i], NULL);
+    pthread_mutex_destroy(&b.lock);
+    Py_END_ALLOW_THREADS;
+
+    ret = PyList_New(b.nb);
+    if (ret == NULL)
+        goto cleanup;
+    for (i = 0; i < b.nb; i++) {
+        if (b.results[i] != 0)
+            printf("Error during libexiftran.run_batch(%i,%s)\n", b.actions[i], b.names[i]);
+        PyList_SET_ITEM(ret, i, PyInt_FromLong(b.results[i]));
+    }
+
+cleanup:
+    if (b.names != NULL)
+        for (i = 0; i < b.nb; i++)
+            free(b.names[i]);
+    free(b.names);
+    free(b.actions);
+    free(b.results);
+    free(threads);
+    Py_DECREF(seq);
+    return ret;
+}
+
+
+/* ------------------------------------------------------- */
+static PyObject *
+libexiftran_transform(PyObject *self, PyObject *args)
+{
+    const char *data;
+    int action, size, rc;
+    unsigned char *out;
+    size_t osize;
+    PyObject *ret;
+
+    if (!PyArg_ParseTuple(args, "is#", &action, &data, &size))
+        return NULL;
+    /* the input is an immutable string kept alive by args */
+    Py_BEGIN_ALLOW_THREADS;
+    rc = pylib_mem(action, (unsigned char *)data, size, &out, &osize);
+    Py_END_ALLOW_THREADS;
+
+    if (rc != 0) {
+        PyErr_Format(exiftranError, "Error during libexiftran.transform(%i) of %i bytes", action, size);
+        return NULL;
+    }
+    ret = PyString_FromStringAndSize((char *)out, osize);
+    free(out);
+    return ret;
+}
+
+
+/* ------------------------------------------------------- */
+static PyObject *
+libexiftran_thumbnail(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"filename", "size", "quality", "progressive", "optimize", "output", NULL};
+    const char *filename, *output = NULL;
+    int size = 160, quality = 75, progressive = 0, optimize = 0;
+    int osize, written = 0;
+    unsigned char *data;
+    FILE *fp;
+    PyObject *ret;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|iiiiz", kwlist, &filename, &size,
+                                     &quality, &progressive, &optimize, &output))
+        return NULL;
+    if (size <= 0) {
+        PyErr_SetString(PyExc_ValueError, "size must be positive");
+        return NULL;
+    }
+    /* filename and output belong to args which is kept alive */
+    Py_BEGIN_ALLOW_THREADS;
+    data = create_thumbnail_mem((char *)filename, size, quality, progressive, optimize, &osize);
+    if (data != NULL && osize > 0 && output != NULL) {
+        fp = fopen(output, "wb");
+        if (fp != NULL) {
+            written = fwrite(data, 1, osize, fp);
+            if (fclose(fp) != 0)
+                written = -1;
+        } else
+            written = -1;
+    }
+    Py_END_ALLOW_THREADS;
+
+    if (data == NULL || osize <= 0) {
+        free(data);
+        PyErr_Format(exiftranError, "Error during libexiftran.thumbnail(%s)", filename);
+        return NULL;
+    }
+    if (output == NULL)
+        ret = PyString_FromStringAndSize((char *)data, osize);
+    else if (written != osize)
+        ret = PyErr_SetFromErrnoWithFilename(PyExc_IOError, (char *)output);
+    else
+        ret = PyInt_FromLong(osize);
+    free(data);
+    return ret;
+}
+
+
 /* Module methods */
 static PyMethodDef libexiftranMethods[] ={
     {"run", libexiftran_run, METH_VARARGS},
+    {"run_batch", libexiftran_run_batch, METH_VARARGS,
+     "run_batch(list of (action, filename), nbthreads=0): transform many files with a pool of threads, "
+     "one per processor by default. Returns the list of return codes"},
+    {"transform", libexiftran_transform, METH_VARARGS,
+     "transform(action, data): transform a JPEG image given as a string and return the new JPEG image, "
+     "with the Exif orientation, dimensions and thumbnail updated"},
+    {"thumbnail", (PyCFunction)libexiftran_thumbnail, METH_VARARGS | METH_KEYWORDS,
+     "thumbnail(filename, size=160, quality=75, progressive=0, optimize=0, output=None): "
+     "make a thumbnail fitting in a size x size box from a JPEG file. "
+     "Returns the JPEG data, or the number of bytes written if output is given"},
     {NULL,NULL, 0, NULL} /* sentinel */
 };
 
@@ -45,10 +254,10 @@ initlibexiftran(void)
     m = Py_InitModule("libexiftran", libexiftranMethods);
 
     /* Add some symbolic constants to the module */
-//    d = PyModule_GetDict(m);
+    d = PyModule_GetDict(m);
 
 //    import_array();
-//    libexiftranError = PyErr_NewException("libexiftran.error", NULL, NULL);
-//    PyDict_SetItemString(d, "error", libexiftranError);
+    exiftranError = PyErr_NewException("libexiftran.error", NULL, NULL);
+    PyDict_SetItemString(d, "error", exiftranError);
 }
 
@@ -22,7 +22,7 @@ setup (
          name='libexiftran',
          sources=sources,
          define_macros=define_macros,
-         libraries=["jpeg", "exif", "m"],
+         libraries=["jpeg", "exif", "m", "pthread"],
 #               include_dirs=["/usr/include/libexif"]
          ),
     ],
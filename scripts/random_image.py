@@ -35,7 +35,9 @@ import os, sys, logging, random
 from imagizer.fileutils import findFiles
 from imagizer.config    import Config
 from imagizer.photo     import Photo
+from imagizer.metadataindex import MetadataIndex
 config = Config()
+metadataIndex = MetadataIndex()
 logger = logging.getLogger("imagizer.random_image")
 
 def create_link(linkName,lst=[]):
@@ -52,13 +54,15 @@ def create_link(linkName,lst=[]):
             lst = findFiles(config.DefaultRepository)
             random.shuffle(lst)
         imFile = lst.pop()
-        photo = Photo(imFile)
-        metadata = photo.readExif()
-        rate = metadata.get("Rate", 0)
+        entry = metadataIndex.get(imFile)
+        if entry is None:
+            rate = Photo(imFile, dontCache=True).readExif().get("Rate", 0)
+        else:
+            rate = entry["rate"]
         rating = 0.01 + 0.2 * rate
         if random.random() < rating:
             print("%s[%s] ---> %s" % (imFile, rate, linkName))
-            os.symlink(photo.fn, linkName)
+            os.symlink(os.path.join(config.DefaultRepository, imFile), linkName)
             break
 
 if (len(sys.argv) < 2):
@@ -97,7 +97,7 @@ setup(name='Imagizer',
              name='libexiftran',
              sources=[os.path.join("libexiftran", i) for i in os.listdir("libexiftran") if i.endswith(".c")],
              define_macros=[],
-             libraries=["jpeg", "exif", "m"],
+             libraries=["jpeg", "exif", "m", "pthread"],
          ),
     ],
     classifiers=[